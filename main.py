@@ -1,5 +1,6 @@
 import os
 import shutil
+import argparse
 import logging
 from pathlib import Path
 import numpy as np
@@ -9,10 +10,15 @@ import yaml
 from scripts.cropping_imgs import process_dataset
 from scripts.bg_removal import remove_bg_batch
 from scripts.bg_extraction_web_scraping import download_backgrounds
-from scripts.overlay import overlay_foreground_on_background
+from scripts.overlay import clear_composite_outputs, overlay_foreground_on_background, overlay_with_quotas
+from scripts.foreground_atlas import build_foreground_atlas
 from scripts.label_conversion import convert_json_to_yolo, convert_pascal_voc_to_yolo
 from scripts.yolo_to_json import convert_dataset_to_coco
 from scripts.yolo_to_mask import yolo_to_masks
+from scripts.pipeline import run_pipelined
+from scripts.profiling import PROFILE_MODES, StageProfiler
+from scripts.watch import WatchDaemon
+from scripts.planner import plan_run
 
 # -----------------------------
 # CONFIGURATION
@@ -36,6 +42,8 @@ COMPOSITES_DIR = os.path.join(DATA_ROOT, config["paths"]["output"]["composites"]
 ANNOTATIONS_DIR = os.path.join(DATA_ROOT, config["paths"]["output"]["annotations"])
 COCO_JSON_PATH = os.path.join(DATA_ROOT, config["paths"]["output"]["coco_json"])
 MASKS_DIR = os.path.join(DATA_ROOT, config["paths"]["output"]["masks"])
+INSTANCES_DIR = os.path.join(DATA_ROOT, config["paths"]["output"]["instances"])
+CLASS_NAMES_FILE = os.path.join(DATA_ROOT, config["paths"]["input"]["class_names"])
 SEARCH_KEYWORD = config["search"]["keyword"]
 NUM_BACKGROUNDS = config["search"]["num_backgrounds"]
 # -----------------------------
@@ -69,6 +77,13 @@ def get_average_image_dimensions(images_dir):
     log.info(f"Average image dimensions: {avg_width}x{avg_height}")
     return avg_width, avg_height
 
+def load_class_names(path):
+    if not os.path.exists(path):
+        log.warning(f"Class names file not found: {path}")
+        return []
+    with open(path, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
 def setup_and_prepare_dataset(original_images_dir=None, original_labels_dir=None, original_class_name_file=None, original_test_dir=None):
     required_dirs = [
         "data",
@@ -134,108 +149,245 @@ def setup_and_prepare_dataset(original_images_dir=None, original_labels_dir=None
         shutil.rmtree(original_test_dir)
         log.info(f"Removed original test directory: {original_test_dir}")
 
+def run_overlay(class_names, bg_sources):
+    # Leftover composites or instance maps of a longer earlier run would be
+    # exported to COCO with this run's data
+    clear_composite_outputs(COMPOSITES_DIR, ANNOTATIONS_DIR, INSTANCES_DIR)
+    # Foregrounds are decoded once and shared by every background source
+    atlas = build_foreground_atlas(CROPPED_NOBG_DIR, class_names)
+    next_index = 1
+    try:
+        if config["overlay"]["quotas"]["enabled"]:
+            log.info("Overlaying foregrounds to meet per-class quotas...")
+            overlay_with_quotas(
+                atlas=atlas,
+                backgrounds_dirs=bg_sources,
+                composites_dir=COMPOSITES_DIR,
+                annotations_dir=ANNOTATIONS_DIR,
+                class_names=class_names,
+                instances_dir=INSTANCES_DIR
+            )
+            return
+        for bg_source in bg_sources:
+            if os.path.exists(bg_source):
+                log.info(f"Overlaying foregrounds on backgrounds from: {bg_source}")
+                next_index = overlay_foreground_on_background(
+                    foregrounds_dir=CROPPED_NOBG_DIR,
+                    backgrounds_dir=bg_source,
+                    composites_dir=COMPOSITES_DIR,
+                    annotations_dir=ANNOTATIONS_DIR,
+                    class_names=class_names,
+                    atlas=atlas,
+                    start_index=next_index,
+                    instances_dir=INSTANCES_DIR
+                )
+    finally:
+        atlas.close()
+
 # -----------------------------
 # MAIN PIPELINE
 # -----------------------------
-def main():
+def main(profiler=None):
+    # Profiling is opt-in; a disabled StageProfiler turns every stage() into a no-op
+    if profiler is None:
+        profiler = StageProfiler()
     try:
         # Provide these if images/labels are not already in input/
         original_images_dir = os.path.join(DATA_ROOT,"images")
         original_labels_dir = os.path.join(DATA_ROOT,"labels")
         original_test_dir = os.path.join(DATA_ROOT,"test")
         original_class_names_file = os.path.join(DATA_ROOT,"class_names.txt")
-        CLASS_NAMES = os.path.join(DATA_ROOT, "input", "class_names.txt")
-        CLASS_MAP = {name: idx for idx, name in enumerate(CLASS_NAMES)}
 
+        with profiler.stage("setup"):
+            setup_and_prepare_dataset(original_images_dir, original_labels_dir, original_class_names_file, original_test_dir)
 
-        setup_and_prepare_dataset(original_images_dir, original_labels_dir, original_class_names_file, original_test_dir)
+        CLASS_NAMES = load_class_names(CLASS_NAMES_FILE)
+        CLASS_MAP = {name: idx for idx, name in enumerate(CLASS_NAMES)}
 
         # Step 1: Convert annotations
-        if os.path.exists(JSON_ANNOTATIONS_DIR) and any(f.endswith(".jsonl") for f in os.listdir(JSON_ANNOTATIONS_DIR)):
-            log.info("Converting JSON annotations to YOLO format...")
-            convert_json_to_yolo(JSON_ANNOTATIONS_DIR, LABELS_DIR, CLASS_MAP)
-        elif os.path.exists(XML_ANNOTATIONS_DIR) and any(f.endswith(".xml") for f in os.listdir(XML_ANNOTATIONS_DIR)):
-            log.info("Converting XML annotations to YOLO format...")
-            convert_pascal_voc_to_yolo(XML_ANNOTATIONS_DIR, LABELS_DIR, CLASS_NAMES)
-        else:
-            log.warning("No JSON or XML annotations found. Skipping annotation conversion.")
-
-        # Step 2: Crop images
-        log.info("Cropping objects from input images...")
-        process_dataset(IMAGES_DIR, LABELS_DIR, CROPPED_DIR, CLASS_NAMES)
-
-        # Step 3: Background removal
-        log.info("Removing background from cropped images...")
-        remove_bg_batch(CROPPED_DIR, CROPPED_NOBG_DIR)
+        with profiler.stage("annotations"):
+            if os.path.exists(JSON_ANNOTATIONS_DIR) and any(f.endswith(".jsonl") for f in os.listdir(JSON_ANNOTATIONS_DIR)):
+                log.info("Converting JSON annotations to YOLO format...")
+                convert_json_to_yolo(JSON_ANNOTATIONS_DIR, LABELS_DIR, CLASS_MAP)
+            elif os.path.exists(XML_ANNOTATIONS_DIR) and any(f.endswith(".xml") for f in os.listdir(XML_ANNOTATIONS_DIR)):
+                log.info("Converting XML annotations to YOLO format...")
+                convert_pascal_voc_to_yolo(XML_ANNOTATIONS_DIR, LABELS_DIR, CLASS_NAMES)
+            else:
+                log.warning("No JSON or XML annotations found. Skipping annotation conversion.")
+
+        pipelined = config["pipeline"]["mode"] == "pipelined"
+        bg_sources = [os.path.join(WEBSCRAPE_BG_DIR, SEARCH_KEYWORD), USER_BG_DIR]
+
+        if not pipelined:
+            # Step 2: Crop images
+            log.info("Cropping objects from input images...")
+            with profiler.stage("crop"):
+                process_dataset(IMAGES_DIR, LABELS_DIR, CROPPED_DIR, CLASS_NAMES, foreground_dir=CROPPED_NOBG_DIR)
+
+            # Step 3: Background removal (mask-derived crops are already in CROPPED_NOBG_DIR)
+            log.info("Removing background from cropped images...")
+            with profiler.stage("bg_removal"):
+                remove_bg_batch(CROPPED_DIR, CROPPED_NOBG_DIR, clear_output=False)
 
         # Step 4: Background download
         log.info(f"Downloading {NUM_BACKGROUNDS} backgrounds for: {SEARCH_KEYWORD}")
-        avg_w, avg_h = get_average_image_dimensions(IMAGES_DIR)
-        download_backgrounds(
-            keyword=SEARCH_KEYWORD,
-            limit=NUM_BACKGROUNDS,
-            output_dir=WEBSCRAPE_BG_DIR,
-            width=avg_w,
-            height=avg_h
-        )
-
-        # Step 5: Overlay
-        for bg_source in [os.path.join(WEBSCRAPE_BG_DIR, SEARCH_KEYWORD), USER_BG_DIR]:
-            if os.path.exists(bg_source):
-                log.info(f"Overlaying foregrounds on backgrounds from: {bg_source}")
-                overlay_foreground_on_background(
+        with profiler.stage("backgrounds"):
+            avg_w, avg_h = get_average_image_dimensions(IMAGES_DIR)
+            download_backgrounds(
+                keyword=SEARCH_KEYWORD,
+                limit=NUM_BACKGROUNDS,
+                output_dir=WEBSCRAPE_BG_DIR,
+                width=avg_w,
+                height=avg_h
+            )
+
+        if pipelined:
+            # Steps 2, 3, 5 and 7 run concurrently: crops flow through background
+            # removal into compositing, and masks are written with each composite.
+            log.info("Running crop -> background removal -> composite -> masks as a pipeline...")
+            with profiler.stage("pipeline"):
+                run_pipelined(
+                    images_dir=IMAGES_DIR,
+                    labels_dir=LABELS_DIR,
+                    cropped_dir=CROPPED_DIR,
                     foregrounds_dir=CROPPED_NOBG_DIR,
-                    backgrounds_dir=bg_source,
+                    backgrounds_dirs=bg_sources,
                     composites_dir=COMPOSITES_DIR,
                     annotations_dir=ANNOTATIONS_DIR,
-                    class_names=CLASS_NAMES
+                    masks_dir=MASKS_DIR,
+                    class_names=CLASS_NAMES,
+                    instances_dir=INSTANCES_DIR
                 )
+        else:
+            # Step 5: Overlay
+            with profiler.stage("overlay"):
+                run_overlay(CLASS_NAMES, bg_sources)
 
         # Step 6: Convert to COCO
         log.info("Converting YOLO annotations to COCO format...")
-        convert_dataset_to_coco(
-            images_dir=COMPOSITES_DIR,
-            labels_dir=ANNOTATIONS_DIR,
-            output_json=COCO_JSON_PATH,
-            label_format="yolo",
-            class_names=CLASS_NAMES
-        )
+        with profiler.stage("coco"):
+            convert_dataset_to_coco(
+                images_dir=COMPOSITES_DIR,
+                labels_dir=ANNOTATIONS_DIR,
+                output_json=COCO_JSON_PATH,
+                label_format="yolo",
+                class_names=CLASS_NAMES,
+                instances_dir=INSTANCES_DIR
+            )
 
         # Step 7: Generate masks
-        log.info("Generating masks from YOLO annotations...")
-        yolo_to_masks(COMPOSITES_DIR, ANNOTATIONS_DIR, MASKS_DIR)
-
-        # Copy original images to composites folder
-        for img_file in Path(IMAGES_DIR).glob("*.[jp][pn]g"):
-            dst = Path(COMPOSITES_DIR) / f"orig_{img_file.name}"
-            shutil.copy(img_file, dst)
-        log.info("Original images copied to composites folder.")
-
-        # Copy original labels to annotations folder
-        for label_file in Path(LABELS_DIR).glob("*.txt"):
-            dst = Path(ANNOTATIONS_DIR) / f"orig_{label_file.name}"
-            shutil.copy(label_file, dst)
-        log.info("Original labels copied to annotations folder.")
-
-        # Generate masks for original images too
-        temp_mask_dir = os.path.join(DATA_ROOT, "intermediate", "orig_masks")
-        os.makedirs(temp_mask_dir, exist_ok=True)
-        yolo_to_masks(IMAGES_DIR, LABELS_DIR, temp_mask_dir)
-
-        # Copy masks to final output
-        for mask_file in Path(temp_mask_dir).glob("*.png"):
-            dst = Path(MASKS_DIR) / f"orig_{mask_file.name}"
-            shutil.copy(mask_file, dst)
-        log.info("Original masks copied to masks folder.")
+        if not pipelined:
+            log.info("Generating masks from YOLO annotations...")
+            with profiler.stage("masks"):
+                yolo_to_masks(COMPOSITES_DIR, ANNOTATIONS_DIR, MASKS_DIR)
+
+        with profiler.stage("originals"):
+            copy_originals()
 
         log.info("Pipeline completed successfully!")
 
 
     except Exception as e:
         log.exception(f"Pipeline failed: {e}")
+    finally:
+        profiler.finish()
+
+def copy_originals():
+    # Copy original images to composites folder
+    for img_file in Path(IMAGES_DIR).glob("*.[jp][pn]g"):
+        dst = Path(COMPOSITES_DIR) / f"orig_{img_file.name}"
+        shutil.copy(img_file, dst)
+    log.info("Original images copied to composites folder.")
+
+    # Copy original labels to annotations folder
+    for label_file in Path(LABELS_DIR).glob("*.txt"):
+        dst = Path(ANNOTATIONS_DIR) / f"orig_{label_file.name}"
+        shutil.copy(label_file, dst)
+    log.info("Original labels copied to annotations folder.")
+
+    # Generate masks for original images too
+    temp_mask_dir = os.path.join(DATA_ROOT, "intermediate", "orig_masks")
+    os.makedirs(temp_mask_dir, exist_ok=True)
+    yolo_to_masks(IMAGES_DIR, LABELS_DIR, temp_mask_dir)
+
+    # Copy masks to final output
+    for mask_file in Path(temp_mask_dir).glob("*.png"):
+        dst = Path(MASKS_DIR) / f"orig_{mask_file.name}"
+        shutil.copy(mask_file, dst)
+    log.info("Original masks copied to masks folder.")
+
+def run_watch():
+    """
+    Daemon mode: prepare the dataset once, then keep models and backgrounds
+    warm and process images as they are dropped into data_root/images (with
+    labels in data_root/labels) or the input folders.
+    """
+    original_images_dir = os.path.join(DATA_ROOT, "images")
+    original_labels_dir = os.path.join(DATA_ROOT, "labels")
+    # The inboxes are not passed to setup: it deletes them after copying, which
+    # would drop files waiting there. The daemon ingests them itself.
+    setup_and_prepare_dataset(original_class_name_file=os.path.join(DATA_ROOT, "class_names.txt"))
+    daemon = WatchDaemon(
+        images_dir=IMAGES_DIR,
+        labels_dir=LABELS_DIR,
+        cropped_dir=CROPPED_DIR,
+        foregrounds_dir=CROPPED_NOBG_DIR,
+        backgrounds_dirs=[os.path.join(WEBSCRAPE_BG_DIR, SEARCH_KEYWORD), USER_BG_DIR],
+        composites_dir=COMPOSITES_DIR,
+        annotations_dir=ANNOTATIONS_DIR,
+        masks_dir=MASKS_DIR,
+        instances_dir=INSTANCES_DIR,
+        coco_json=COCO_JSON_PATH,
+        class_names=load_class_names(CLASS_NAMES_FILE),
+        inboxes={original_images_dir: IMAGES_DIR, original_labels_dir: LABELS_DIR}
+    )
+    daemon.run()
+
+def run_plan():
+    """
+    Dry run: report what main() would produce with the current config.yaml,
+    without running setup, downloading backgrounds or writing outputs.
+    """
+    # Before the first run the data is still in data_root/images and data_root/labels
+    images_dir, labels_dir = IMAGES_DIR, LABELS_DIR
+    if not any(Path(images_dir).glob("*.[jp][pn]g")) and os.path.isdir(os.path.join(DATA_ROOT, "images")):
+        images_dir, labels_dir = os.path.join(DATA_ROOT, "images"), os.path.join(DATA_ROOT, "labels")
+    class_names_file = CLASS_NAMES_FILE if os.path.exists(CLASS_NAMES_FILE) else os.path.join(DATA_ROOT, "class_names.txt")
+    web_dir = os.path.join(WEBSCRAPE_BG_DIR, SEARCH_KEYWORD)
+    plan_run(
+        images_dir=images_dir,
+        labels_dir=labels_dir,
+        backgrounds_dirs=[web_dir, USER_BG_DIR],
+        web_dir=web_dir,
+        class_names=load_class_names(class_names_file),
+        output_json=os.path.join(OUTPUT_ROOT, "plan.json")
+    )
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Synthetic medical image augmentation pipeline")
+    parser.add_argument("--profile", action="store_true",
+                        help="profile every stage and write reports to <output>/profile")
+    parser.add_argument("--profiler", choices=PROFILE_MODES, default="cprofile",
+                        help="cprofile (deterministic, main thread and workers; flamegraphs approximated from the caller graph) "
+                             "or sampling (all threads, flamegraphs from real stacks)")
+    parser.add_argument("--profile-top", type=int, default=25, help="functions listed in each top-N summary")
+    parser.add_argument("--plan", action="store_true",
+                        help="dry run: count the work per stage and estimate run time and disk usage")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and process new images as they arrive instead of a full run")
+    return parser.parse_args(argv)
 
 # -----------------------------
 # ENTRY POINT
 # -----------------------------
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    args = parse_args()
+    if args.plan:
+        run_plan()
+    elif args.watch:
+        run_watch()
+    else:
+        profiler = None
+        if args.profile:
+            profiler = StageProfiler(os.path.join(OUTPUT_ROOT, "profile"), args.profiler, args.profile_top)
+        main(profiler)
@@ -1,33 +1,383 @@
-from bing_image_downloader import downloader
+import io
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
 import logging
-from PIL import Image
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+from PIL import Image
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import yaml
+
+def load_yaml(path = "config.yaml"):
+    with open(path,'r') as f:
+        return yaml.safe_load(f)
+
+config = load_yaml()
 
 log = logging.getLogger(__name__)
 
-def download_backgrounds(keyword, limit, output_dir,width=None,height=None):
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+
+def create_http_client(pool_size: int, retries: int) -> requests.Session:
+    """
+    A requests session with a connection pool of pool_size per host and
+    retries with backoff on connection errors and 429/5xx responses.
+    """
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+# A source yields candidate image locations: http(s) URLs, or file:// URLs
+# when its reads_files is set. It may yield more than are needed; the fetcher
+# stops pulling once it has enough images.
+
+class BingSearchSource:
+    """
+    Image results of a Bing image search, read page by page from the async
+    results endpoint (the same one bing_image_downloader scrapes).
+    """
+
+    name = "bing"
+    reads_files = False
+
+    def __init__(self, keyword: str, endpoint: str = "https://www.bing.com/images/async", page_size: int = 35):
+        self.keyword = keyword
+        self.endpoint = endpoint
+        self.page_size = page_size
+
+    def urls(self, client: requests.Session, timeout: float) -> Iterator[str]:
+        seen = set()
+        first = 0
+        while True:
+            response = client.get(
+                self.endpoint,
+                params={"q": self.keyword, "first": first, "count": self.page_size, "adlt": "off"},
+                timeout=timeout
+            )
+            response.raise_for_status()
+            links = re.findall(r"murl&quot;:&quot;(.*?)&quot;", response.text)
+            fresh = [link for link in links if link not in seen]
+            if not fresh:
+                return
+            for link in fresh:
+                seen.add(link)
+                yield link
+            first += len(links)
+
+class UrlListSource:
+    """
+    A fixed list of image URLs, or a text file with one URL per line. Local
+    files can be listed as explicit file:// URLs.
+    """
+
+    name = "urls"
+    reads_files = True
+
+    def __init__(self, urls):
+        if isinstance(urls, (str, Path)):
+            with open(urls, 'r') as f:
+                urls = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        self.url_list = list(urls)
+
+    def urls(self, client: requests.Session, timeout: float) -> Iterator[str]:
+        return iter(self.url_list)
+
+class LocalDirectorySource:
+    """
+    Image files already on disk, e.g. a shared background library.
+    """
+
+    name = "local"
+    reads_files = True
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def urls(self, client: requests.Session, timeout: float) -> Iterator[str]:
+        for filename in sorted(os.listdir(self.directory)):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                yield Path(self.directory, filename).resolve().as_uri()
+
+BACKGROUND_SOURCES = {
+    "bing": BingSearchSource,
+    "urls": UrlListSource,
+    "local": LocalDirectorySource,
+}
+
+def create_source(name: str, keyword: str):
+    """
+    The source configured under config.yaml > search: bing searches for
+    keyword, urls reads search.urls_file, local lists search.local_dir.
+    """
+    if name not in BACKGROUND_SOURCES:
+        raise ValueError(f"Unknown background source '{name}'. Use one of: {', '.join(BACKGROUND_SOURCES)}")
+    if name == "bing":
+        return BingSearchSource(keyword)
+    if name == "urls":
+        return UrlListSource(config["search"]["urls_file"])
+    return LocalDirectorySource(config["search"]["local_dir"])
+
+class ContentCache:
+    """
+    Downloaded files stored once by SHA-256 of their content under
+    objects/ab/<hash><ext>, plus a JSON index from source URL to hash. Objects
+    are written atomically, so an interrupted run leaves no partial files and
+    the next run only fetches the URLs it had not finished.
+    """
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.index_path = self.root / "index.json"
+        self.index: Dict[str, dict] = {}
+        if self.index_path.exists():
+            try:
+                with self.index_path.open('r') as f:
+                    self.index = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                log.warning(f"Ignoring unreadable background cache index {self.index_path}: {e}")
+        self._unsaved = 0
+
+    def object_path(self, digest: str, ext: str) -> Path:
+        return self.root / "objects" / digest[:2] / f"{digest}{ext}"
+
+    def lookup(self, url: str) -> Optional[Tuple[str, Path]]:
+        entry = self.index.get(url)
+        if entry is None:
+            return None
+        path = self.object_path(entry["sha256"], entry["ext"])
+        return (entry["sha256"], path) if path.exists() else None
+
+    def store(self, url: str, data: bytes, ext: str) -> Tuple[str, Path]:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest, ext)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(path.suffix + ".part")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        self.index[url] = {"sha256": digest, "ext": ext}
+        self._unsaved += 1
+        if self._unsaved >= 25:
+            self.save()
+        return digest, path
+
+    def save(self) -> None:
+        if not self._unsaved:
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.index_path.with_suffix(".tmp")
+        with tmp.open('w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, self.index_path)
+        self._unsaved = 0
+
+def _fetch(client: requests.Session, url: str, timeout: float, reads_files: bool = False) -> Tuple[bytes, str]:
+    """
+    Bytes and file extension of one image. file:// URLs are only read when
+    reads_files is set; anything else goes through the HTTP client. Raises if
+    it cannot be fetched or is not a decodable image.
+    """
+    scheme = urlparse(url).scheme
+    if scheme == "file":
+        if not reads_files:
+            raise ValueError("local files are not read from this source")
+        data = Path(url2pathname(urlparse(url).path)).read_bytes()
+    elif scheme not in ("http", "https"):
+        raise ValueError(f"unsupported URL scheme '{scheme}'")
+    else:
+        response = client.get(url, timeout=timeout)
+        response.raise_for_status()
+        data = response.content
+    with Image.open(io.BytesIO(data)) as img:
+        img_format = img.format
+        img.verify()
+    ext = {"JPEG": ".jpg", "PNG": ".png", "BMP": ".bmp", "WEBP": ".webp"}.get(img_format)
+    if ext is None:
+        raise ValueError(f"unsupported image format {img_format}")
+    return data, ext
+
+def _resize(src: str, dst: str, width: Optional[int], height: Optional[int]) -> str:
+    """
+    Write src to dst resized to width x height, or copied when no size is given.
+    Runs in the resize worker pool.
+    """
+    if width and height:
+        with Image.open(src) as img:
+            img.convert("RGB").resize((width, height), Image.Resampling.LANCZOS).save(dst, quality=95)
+    else:
+        shutil.copyfile(src, dst)
+    return dst
+
+def _output_is_current(path: Path, width: Optional[int], height: Optional[int]) -> bool:
+    if not path.exists():
+        return False
+    if not (width and height):
+        return True
     try:
-        downloader.download(
-            keyword,
-            limit=limit,
-            output_dir=str(output_dir),
-            adult_filter_off=True,
-            force_replace=False,
-            timeout=60
-        )
-        log.info(f"Downloaded {limit} backgrounds with keyword: '{keyword}'")
-
-        if width and height:
-            downloaded_path = Path(output_dir) / keyword
-            for img_file in downloaded_path.glob("*.[jp][pn]g"):
+        with Image.open(path) as img:
+            return img.size == (width, height)
+    except Exception:
+        return False
+
+def fetch_backgrounds(
+    source,
+    limit: int,
+    output_dir: str,
+    width: Optional[int] = None,
+    height: Optional[int] = None,
+    cache_dir: Optional[str] = None,
+    concurrency: int = config["fetch"]["concurrency"],
+    timeout: float = config["fetch"]["timeout"],
+    retries: int = config["fetch"]["retries"],
+    resize_workers: int = config["fetch"]["resize_workers"]
+) -> dict:
+    """
+    Fill output_dir up to limit distinct background images from source, named
+    by content hash and resized to width x height if given. Images already in
+    output_dir count against limit, so repeated runs do not grow it.
+
+    Downloads share one pooled HTTP client with at most concurrency requests
+    in flight; URLs already in the content cache are not fetched again and
+    outputs already at the right size are not rewritten. Resizing runs in a
+    pool of resize_workers threads (PIL releases the GIL while decoding,
+    resampling and encoding). Returns counts, failures and throughput.
+    """
+    start = time.perf_counter()
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    cache = ContentCache(cache_dir or os.path.join(config["data_root"], config["fetch"]["cache"]))
+    client = create_http_client(concurrency, retries)
+
+    existing = {p.stem for p in output_dir.iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS}
+    budget = max(limit - len(existing), 0)
+    collected: Dict[str, Path] = {}
+    failures: List[Tuple[str, str]] = []
+    cached = downloaded = 0
+    reads_files = getattr(source, "reads_files", False)
+
+    def accept(digest: str, path: Path) -> bool:
+        # Outputs are named by the first 16 hex digits of the content hash
+        if digest[:16] in existing or digest in collected or len(collected) >= budget:
+            return False
+        collected[digest] = path
+        return True
+
+    urls = iter(source.urls(client, timeout)) if budget else iter(())
+    exhausted = not budget
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            in_flight = {}
+            while len(collected) < budget and not (exhausted and not in_flight):
+                # Top up with cache hits first, then keep at most `concurrency` downloads running
+                while not exhausted and len(collected) + len(in_flight) < budget and len(in_flight) < concurrency:
+                    try:
+                        url = next(urls)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    except requests.RequestException as e:
+                        log.error(f"Background source '{source.name}' failed: {e}")
+                        exhausted = True
+                        break
+                    hit = cache.lookup(url)
+                    if hit is not None:
+                        cached += accept(*hit)
+                        continue
+                    in_flight[pool.submit(_fetch, client, url, timeout, reads_files)] = url
+
+                if not in_flight:
+                    continue
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url = in_flight.pop(future)
+                    try:
+                        data, ext = future.result()
+                    except Exception as e:
+                        failures.append((url, str(e)))
+                        log.debug(f"Failed to fetch {url}: {e}")
+                        continue
+                    downloaded += 1
+                    accept(*cache.store(url, data, ext))
+            # Downloads still running once the limit is reached are kept for the next run
+            for future, url in in_flight.items():
                 try:
-                    img = Image.open(img_file).convert("RGB")
-                    img = img.resize((width, height), Image.Resampling.LANCZOS)
-                    img.save(img_file)
+                    cache.store(url, *future.result())
+                except Exception:
+                    pass
+    finally:
+        cache.save()
+        client.close()
+    fetch_seconds = time.perf_counter() - start
+
+    resize_start = time.perf_counter()
+    jobs = []
+    for digest, path in collected.items():
+        target = output_dir / (f"{digest[:16]}.jpg" if width and height else f"{digest[:16]}{path.suffix}")
+        if not _output_is_current(target, width, height):
+            jobs.append((str(path), str(target), width, height))
+    resized = 0
+    if jobs:
+        with ThreadPoolExecutor(max_workers=max(1, resize_workers)) as pool:
+            futures = {pool.submit(_resize, *job): job for job in jobs}
+            for future in futures:
+                try:
+                    future.result()
+                    resized += 1
                 except Exception as e:
-                    log.warning(f"Failed to resize {img_file}: {e}")
-            log.info(f"Resized all images in '{downloaded_path}' to {width}x{height}")
+                    failures.append((futures[future][0], f"resize failed: {e}"))
+    resize_seconds = time.perf_counter() - resize_start
+    elapsed = time.perf_counter() - start
+
+    total = len(existing) + len(collected)
+    report = {
+        "images": total,
+        "existing": len(existing),
+        "downloaded": downloaded,
+        "cached": cached,
+        "resized": resized,
+        "failed": len(failures),
+        "failures": failures,
+        "download_images_per_sec": downloaded / fetch_seconds if fetch_seconds else 0.0,
+        "resize_images_per_sec": resized / resize_seconds if resized and resize_seconds else 0.0,
+        "images_per_sec": len(collected) / elapsed if elapsed else 0.0,
+        "elapsed_s": elapsed,
+    }
+    log.info(
+        f"Backgrounds from '{source.name}': {total}/{limit} in {output_dir} "
+        f"({len(existing)} already there, {downloaded} downloaded at {report['download_images_per_sec']:.1f} images/sec, {cached} from cache, "
+        f"{resized} resized at {report['resize_images_per_sec']:.1f} images/sec, {len(failures)} failed) "
+        f"in {elapsed:.1f}s, {report['images_per_sec']:.1f} images/sec overall"
+    )
+    for url, reason in failures[:10]:
+        log.warning(f"  failed: {url}: {reason}")
+    if len(failures) > 10:
+        log.warning(f"  ... and {len(failures) - 10} more failures")
+    if total < limit:
+        log.warning(f"Only {total} of {limit} backgrounds could be collected from '{source.name}'")
+    return report
 
+def download_backgrounds(keyword, limit, output_dir, width=None, height=None, source=None):
+    """
+    Fetch backgrounds for keyword into output_dir/keyword from the source
+    set in config.yaml > search.source (default bing image search).
+    """
+    try:
+        source = source or create_source(config["search"]["source"], keyword)
+        return fetch_backgrounds(source, limit, Path(output_dir) / keyword, width, height)
     except Exception as e:
         log.error(f"Failed to download images for keyword '{keyword}': {e}")
-
@@ -1,57 +1,335 @@
 from rembg import remove, new_session
+import onnxruntime as ort
 import os
+import time
 import shutil
 import logging
+from collections import defaultdict
 from pathlib import Path
+from typing import Dict, List, Optional
 from PIL import Image
 import io
+import cv2
 import numpy as np
 import yaml
 
+from scripts.dedup import filter_near_duplicates
+
 def load_yaml(path = 'config.yaml'):
     with open(path,'r') as f:
         return yaml.safe_load(f)
-    
+
 config = load_yaml()
 
 log = logging.getLogger(__name__)
 
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+
+# rembg session classes that load an arbitrary .onnx file of the same architecture
+CUSTOM_SESSIONS = {
+    "u2net": "u2net_custom",
+    "u2netp": "u2net_custom",
+    "u2net_human_seg": "u2net_custom",
+    "silueta": "u2net_custom",
+    "isnet-general-use": "dis_custom",
+    "isnet-anime": "dis_custom",
+}
+
+def session_options(worker: int = 0) -> ort.SessionOptions:
+    """
+    onnxruntime options from config.yaml > bg_removal.threads. cpu_affinity
+    holds one core list per worker; worker i pins its intra-op threads there.
+    """
+    threads = config["bg_removal"]["threads"]
+    opts = ort.SessionOptions()
+    opts.intra_op_num_threads = threads["intra_op"]
+    opts.inter_op_num_threads = threads["inter_op"]
+    if not threads["allow_spinning"]:
+        opts.add_session_config_entry("session.intra_op.allow_spinning", "0")
+
+    affinity = threads["cpu_affinity"]
+    if affinity:
+        cores = affinity[worker % len(affinity)]
+        opts.intra_op_num_threads = len(cores)
+        if len(cores) > 1:
+            # onnxruntime pins the threads it spawns (all but the caller); ids are 1-based
+            opts.add_session_config_entry(
+                "session.intra_op_thread_affinities", ";".join(str(core + 1) for core in cores[1:])
+            )
+    return opts
+
+def resolve_model(model: str):
+    """
+    Split a model spec into (rembg session name, local .onnx path or None).
+    "<name>.int8" always refers to a quantized file in model_dir; a plain name
+    uses model_dir/<name>.onnx if present, otherwise rembg's own download.
+    """
+    model_dir = Path(config["bg_removal"]["model_dir"])
+    base_name, _, variant = model.partition(".")
+    local_file = model_dir / f"{model}.onnx"
+
+    if variant or local_file.exists():
+        if not local_file.exists():
+            raise FileNotFoundError(f"Model file not found: {local_file}")
+        if base_name not in CUSTOM_SESSIONS:
+            raise ValueError(f"Cannot load a local '{base_name}' model; supported: {', '.join(CUSTOM_SESSIONS)}")
+        return CUSTOM_SESSIONS[base_name], local_file
+
+    if config["bg_removal"]["local_only"]:
+        raise FileNotFoundError(f"{local_file} not found and bg_removal.local_only forbids downloading '{model}'")
+    return model, None
+
+def create_session(model: str = None, worker: int = 0):
+    """
+    rembg session for model (default bg_removal.model) with explicit thread
+    settings. Models are read from and downloaded to model_dir.
+    """
+    model = model or config["bg_removal"]["model"]
+    os.environ.setdefault("U2NET_HOME", str(Path(config["bg_removal"]["model_dir"]).resolve()))
+    session_name, model_path = resolve_model(model)
+    kwargs = {"model_path": str(model_path)} if model_path is not None else {}
+    session = new_session(session_name, sess_opts=session_options(worker), **kwargs)
+    log.info(f"Loaded background removal model '{model}'" + (f" from {model_path}" if model_path else ""))
+    return session
+
 def is_image_significant(image_bytes, min_foreground_pixels):
     img = Image.open(io.BytesIO(image_bytes)).convert("RGBA")
     alpha = np.array(img.split()[-1])
+    return is_alpha_significant(alpha, min_foreground_pixels)
+
+def is_alpha_significant(alpha: np.ndarray, min_foreground_pixels: int) -> bool:
     non_zero = np.count_nonzero(alpha > config["bg_removal"]["min_alpha"])
     return non_zero >= min_foreground_pixels
 
+def size_bucket(size, max_side: Optional[int], step: int) -> int:
+    """
+    Inference-resolution bucket of an image: its long side, capped at max_side
+    and rounded up to a multiple of step.
+    """
+    long_side = max(size)
+    if max_side:
+        long_side = min(long_side, max_side)
+    return -(-long_side // step) * step
+
+def refine_alpha(image: np.ndarray, alpha: np.ndarray, radius: int = 4, eps: float = 1e-3) -> np.ndarray:
+    """
+    Snap an upsampled alpha matte to the edges of the full-resolution image
+    using a grayscale guided filter.
+    """
+    guide = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY).astype(np.float32) / 255.0
+    src = alpha.astype(np.float32) / 255.0
+    ksize = (2 * radius + 1, 2 * radius + 1)
+
+    mean_i = cv2.boxFilter(guide, -1, ksize)
+    mean_p = cv2.boxFilter(src, -1, ksize)
+    cov_ip = cv2.boxFilter(guide * src, -1, ksize) - mean_i * mean_p
+    var_i = cv2.boxFilter(guide * guide, -1, ksize) - mean_i * mean_i
+
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    refined = cv2.boxFilter(a, -1, ksize) * guide + cv2.boxFilter(b, -1, ksize)
+    return np.clip(refined * 255.0, 0, 255).astype(np.uint8)
+
+def predict_alpha(
+    image: Image.Image,
+    session,
+    max_side: Optional[int] = None,
+    refine_edges: bool = False
+) -> np.ndarray:
+    """
+    Predict the foreground alpha of an RGB image. When max_side is set, the
+    model runs on a copy whose long side is at most max_side and the matte is
+    upsampled back to the original resolution.
+    """
+    width, height = image.size
+    scale = min(1.0, max_side / max(width, height)) if max_side else 1.0
+
+    if scale < 1.0:
+        small_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        model_input = image.resize(small_size, Image.Resampling.BILINEAR)
+    else:
+        model_input = image
+
+    mask = remove(model_input, session=session, only_mask=True)
+    alpha = np.array(mask.convert("L"))
+
+    if alpha.shape != (height, width):
+        alpha = cv2.resize(alpha, (width, height), interpolation=cv2.INTER_LINEAR)
+        if refine_edges:
+            alpha = refine_alpha(np.array(image), alpha)
+    return alpha
+
+def bucket_images(image_files: List[Path], max_side: Optional[int], step: int) -> Dict[int, List[Path]]:
+    """
+    Group images by inference-resolution bucket, reading only the image headers.
+    """
+    buckets = defaultdict(list)
+    for image_file in image_files:
+        try:
+            with Image.open(image_file) as img:
+                buckets[size_bucket(img.size, max_side, step)].append(image_file)
+        except Exception as e:
+            log.error(f"Failed to read {image_file.name}: {e}")
+    return dict(sorted(buckets.items()))
+
+def list_images(folder: Path) -> List[Path]:
+    return sorted(f for f in folder.iterdir() if f.suffix.lower() in IMAGE_EXTENSIONS)
 
-def remove_bg_batch(input_folder, output_folder):
+def remove_bg_batch(input_folder, output_folder, session=None, clear_output=True):
     """
-    Remove backgrounds from all images in input_folder using the isnet-general-use model.
+    Remove backgrounds from all images in input_folder with the model from
+    config.yaml > bg_removal.model unless a session is passed in.
+
+    Set clear_output to False to keep foregrounds already in output_folder,
+    such as the mask-derived RGBA crops written by the cropping stage.
+
+    With bg_removal.adaptive.enabled, crops are grouped into size buckets and
+    segmented at a capped resolution, then the alpha matte is upsampled (and
+    optionally edge-refined) back to the crop's native size.
     """
     output_folder = Path(output_folder)
     input_folder = Path(input_folder)
-    
-    if output_folder.exists():
+
+    if clear_output and output_folder.exists():
         log.info(f"Clearing previous outputs in {output_folder}...")
         shutil.rmtree(output_folder)
     output_folder.mkdir(parents=True, exist_ok=True)
 
+    adaptive = config["bg_removal"]["adaptive"]
+    max_side = adaptive["max_inference_side"] if adaptive["enabled"] else None
 
-    for image_file in input_folder.iterdir():
-        if image_file.suffix.lower() not in {'.png', '.jpg', '.jpeg'}:
-            continue
+    if session is None:
+        session = create_session()
 
-        output_file = output_folder / (image_file.stem + "_no_bg.png")
-        try:
-            with image_file.open('rb') as input_f:
-                input_data = input_f.read()
-                output_data = remove(input_data)  
+    image_files = filter_near_duplicates(list_images(input_folder), stage="bg_removal")
+    buckets = bucket_images(image_files, max_side, adaptive["bucket_step"])
+
+    for bucket, image_files in buckets.items():
+        log.info(f"Inference bucket {bucket}px: {len(image_files)} crops")
+        for image_file in image_files:
+            remove_bg_file(image_file, output_folder, session, max_side, adaptive["refine_edges"])
+
+def remove_bg_file(
+    image_file: Path,
+    output_folder: Path,
+    session,
+    max_side: Optional[int] = None,
+    refine_edges: bool = False
+) -> Optional[Path]:
+    """
+    Remove the background of a single crop. Returns the saved foreground path,
+    or None if the crop was skipped or failed.
+    """
+    image_file = Path(image_file)
+    output_file = Path(output_folder) / (image_file.stem + "_no_bg.png")
+    try:
+        img = Image.open(image_file).convert("RGB")
+        alpha = predict_alpha(img, session, max_side, refine_edges)
+
+        if not is_alpha_significant(alpha, config["bg_removal"]["min_foreground_pixels"]):
+            log.info(f"Skipped (too small or empty): {image_file.name}")
+            return None
+
+        img.putalpha(Image.fromarray(alpha))
+        img.save(output_file)
+        log.info(f"Processed: {image_file.name}")
+        return output_file
+    except Exception as e:
+        log.error(f"Failed to process {image_file.name}: {e}")
+        return None
+
+def alpha_iou(alpha_a: np.ndarray, alpha_b: np.ndarray, threshold: int = None) -> float:
+    if threshold is None:
+        threshold = config["bg_removal"]["min_alpha"]
+    a = alpha_a > threshold
+    b = alpha_b > threshold
+    union = np.count_nonzero(a | b)
+    if union == 0:
+        return 1.0
+    return np.count_nonzero(a & b) / union
 
-            if not is_image_significant(output_data,min_foreground_pixels=config["bg_removal"]["min_foreground_pixels"]):
-                log.info(f"Skipped (too small or empty): {image_file.name}")
-                continue
+def compare_adaptive_quality(input_folder, sample_size: int = 25, session=None) -> dict:
+    """
+    Report alpha IoU and throughput of adaptive inference against
+    full-resolution inference on a sample of crops from input_folder.
+    """
+    adaptive = config["bg_removal"]["adaptive"]
+    image_files = list_images(Path(input_folder))[:sample_size]
+    if not image_files:
+        log.warning(f"No images found in {input_folder}")
+        return {}
+
+    if session is None:
+        session = create_session()
+
+    ious = []
+    full_time = adaptive_time = 0.0
+    for image_file in image_files:
+        img = Image.open(image_file).convert("RGB")
+
+        start = time.perf_counter()
+        full_alpha = predict_alpha(img, session)
+        full_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        fast_alpha = predict_alpha(img, session, adaptive["max_inference_side"], adaptive["refine_edges"])
+        adaptive_time += time.perf_counter() - start
+
+        ious.append(alpha_iou(full_alpha, fast_alpha))
+
+    report = {
+        "images": len(image_files),
+        "max_inference_side": adaptive["max_inference_side"],
+        "refine_edges": adaptive["refine_edges"],
+        "mean_iou": float(np.mean(ious)),
+        "min_iou": float(np.min(ious)),
+        "full_res_images_per_sec": len(image_files) / full_time if full_time else 0.0,
+        "adaptive_images_per_sec": len(image_files) / adaptive_time if adaptive_time else 0.0,
+    }
+    log.info(
+        f"Adaptive bg removal on {report['images']} crops: mean IoU {report['mean_iou']:.4f} "
+        f"(min {report['min_iou']:.4f}), {report['full_res_images_per_sec']:.2f} -> "
+        f"{report['adaptive_images_per_sec']:.2f} images/sec"
+    )
+    return report
 
-            with output_file.open('wb') as output_f:
-                output_f.write(output_data)
-            log.info(f"Processed: {image_file.name}")
+def compare_models(input_folder, models: List[str] = None, reference: str = None, sample_size: int = 25) -> dict:
+    """
+    Report throughput (images/sec) and mask agreement (alpha IoU against the
+    reference model, default bg_removal.model) for each model spec in models,
+    default bg_removal.compare_models, on a sample of crops.
+    """
+    models = models or config["bg_removal"]["compare_models"]
+    reference = reference or config["bg_removal"]["model"]
+    image_files = list_images(Path(input_folder))[:sample_size]
+    if not image_files:
+        log.warning(f"No images found in {input_folder}")
+        return {}
+    images = [Image.open(f).convert("RGB") for f in image_files]
+
+    def run(model):
+        session = create_session(model)
+        predict_alpha(images[0], session)  # warm-up, excludes session init from timing
+        start = time.perf_counter()
+        alphas = [predict_alpha(img, session) for img in images]
+        return alphas, len(images) / (time.perf_counter() - start)
+
+    reference_alphas, reference_speed = run(reference)
+    report = {reference: {"images_per_sec": reference_speed, "mean_iou": 1.0, "min_iou": 1.0}}
+    log.info(f"{reference:<20} {reference_speed:7.2f} images/sec (reference)")
+
+    for model in models:
+        if model == reference:
+            continue
+        try:
+            alphas, speed = run(model)
         except Exception as e:
-            log.error(f"Failed to process {image_file.name}: {e}")
+            log.error(f"Skipping model '{model}': {e}")
+            continue
+        ious = [alpha_iou(a, b) for a, b in zip(reference_alphas, alphas)]
+        report[model] = {"images_per_sec": speed, "mean_iou": float(np.mean(ious)), "min_iou": float(np.min(ious))}
+        log.info(
+            f"{model:<20} {speed:7.2f} images/sec (x{speed / reference_speed:.2f}), "
+            f"IoU vs {reference}: mean {report[model]['mean_iou']:.4f}, min {report[model]['min_iou']:.4f}"
+        )
+    return report
@@ -0,0 +1,135 @@
+from typing import Callable, Dict
+import cv2
+import numpy as np
+
+# All blend functions take an opaque RGB uint8 canvas and a premultiplied RGBA
+# uint8 foreground, and composite the foreground at (x, y) in place.
+
+def paste_premultiplied(canvas: np.ndarray, fg: np.ndarray, x: int, y: int, params: dict = None) -> None:
+    """
+    Composite a premultiplied RGBA foreground onto an opaque RGB canvas in place.
+    """
+    h, w = fg.shape[:2]
+    region = canvas[y:y + h, x:x + w]
+    inv_alpha = 255 - fg[..., 3:4].astype(np.uint16)
+    region[:] = fg[..., :3] + (region.astype(np.uint16) * inv_alpha + 127) // 255
+
+def unpremultiply(fg: np.ndarray) -> np.ndarray:
+    """
+    Straight-alpha float32 RGB in [0, 1] of a premultiplied RGBA foreground.
+    """
+    alpha = fg[..., 3:4].astype(np.float32)
+    return fg[..., :3].astype(np.float32) / np.maximum(alpha, 1.0)
+
+def _odd(value: int) -> int:
+    return max(1, int(value)) | 1
+
+def feather_blend(canvas: np.ndarray, fg: np.ndarray, x: int, y: int, params: dict) -> None:
+    """
+    Alpha blend with the matte softened inwards by a Gaussian of feather_radius.
+    """
+    h, w = fg.shape[:2]
+    radius = params["feather_radius"]
+    alpha = fg[..., 3].astype(np.float32) / 255.0
+    ksize = _odd(2 * radius + 1)
+    soft = cv2.GaussianBlur(alpha, (ksize, ksize), 0, borderType=cv2.BORDER_CONSTANT)
+    soft = np.minimum(soft, alpha)[..., None]
+
+    region = canvas[y:y + h, x:x + w]
+    blended = unpremultiply(fg) * 255.0 * soft + region.astype(np.float32) * (1.0 - soft)
+    region[:] = np.clip(blended + 0.5, 0, 255).astype(np.uint8)
+
+def laplacian_blend(canvas: np.ndarray, fg: np.ndarray, x: int, y: int, params: dict) -> None:
+    """
+    Multi-band blend over a region of interest around the foreground only:
+    Laplacian pyramids of foreground and background are mixed with a Gaussian
+    pyramid of the alpha matte and collapsed back into the canvas.
+    """
+    h, w = fg.shape[:2]
+    levels = params["pyramid_levels"]
+    pad = 2 ** levels
+    canvas_h, canvas_w = canvas.shape[:2]
+    x0, y0 = max(0, x - pad), max(0, y - pad)
+    x1, y1 = min(canvas_w, x + w + pad), min(canvas_h, y + h + pad)
+
+    bg_roi = canvas[y0:y1, x0:x1].astype(np.float32)
+    mask = np.zeros(bg_roi.shape[:2], dtype=np.float32)
+    fg_roi = bg_roi.copy()
+    fx, fy = x - x0, y - y0
+    alpha = fg[..., 3].astype(np.float32) / 255.0
+    mask[fy:fy + h, fx:fx + w] = alpha
+    # Outside the lesion the foreground layer is the background itself, so
+    # coarse levels do not bleed black from transparent pixels.
+    inner = fg_roi[fy:fy + h, fx:fx + w]
+    inner[:] = np.where(alpha[..., None] > 0, unpremultiply(fg) * 255.0, inner)
+
+    gauss_fg, gauss_bg, gauss_mask = [fg_roi], [bg_roi], [mask]
+    for _ in range(levels):
+        if min(gauss_mask[-1].shape[:2]) < 2:
+            break
+        gauss_fg.append(cv2.pyrDown(gauss_fg[-1]))
+        gauss_bg.append(cv2.pyrDown(gauss_bg[-1]))
+        gauss_mask.append(cv2.pyrDown(gauss_mask[-1]))
+
+    m = gauss_mask[-1][..., None]
+    blended = gauss_fg[-1] * m + gauss_bg[-1] * (1.0 - m)
+    for level in range(len(gauss_fg) - 2, -1, -1):
+        size = gauss_fg[level].shape[1::-1]
+        lap_fg = gauss_fg[level] - cv2.pyrUp(gauss_fg[level + 1], dstsize=size)
+        lap_bg = gauss_bg[level] - cv2.pyrUp(gauss_bg[level + 1], dstsize=size)
+        m = gauss_mask[level][..., None]
+        blended = cv2.pyrUp(blended, dstsize=size) + lap_fg * m + lap_bg * (1.0 - m)
+
+    canvas[y0:y1, x0:x1] = np.clip(blended + 0.5, 0, 255).astype(np.uint8)
+
+def color_match_blend(canvas: np.ndarray, fg: np.ndarray, x: int, y: int, params: dict) -> None:
+    """
+    Shift the foreground's Lab mean and spread towards the background ring
+    around the placement (color_match_margin pixels wide), then alpha blend.
+    """
+    h, w = fg.shape[:2]
+    margin = params["color_match_margin"]
+    strength = params["color_match_strength"]
+    canvas_h, canvas_w = canvas.shape[:2]
+    x0, y0 = max(0, x - margin), max(0, y - margin)
+    x1, y1 = min(canvas_w, x + w + margin), min(canvas_h, y + h + margin)
+
+    ring = np.ones((y1 - y0, x1 - x0), dtype=bool)
+    ring[y - y0:y - y0 + h, x - x0:x - x0 + w] = fg[..., 3] == 0
+    bg_lab = cv2.cvtColor(canvas[y0:y1, x0:x1], cv2.COLOR_RGB2LAB).astype(np.float32)[ring]
+
+    straight = unpremultiply(fg)
+    fg_lab = cv2.cvtColor(straight, cv2.COLOR_RGB2LAB)
+    inside = fg[..., 3] > 0
+    if bg_lab.size == 0 or not inside.any():
+        paste_premultiplied(canvas, fg, x, y)
+        return
+
+    # float32 Lab has L in [0, 100]; match the 8-bit scale of the background
+    fg_lab[..., 0] *= 255.0 / 100.0
+    fg_lab[..., 1:] += 128.0
+    fg_mean, fg_std = fg_lab[inside].mean(axis=0), fg_lab[inside].std(axis=0) + 1e-3
+    bg_mean, bg_std = bg_lab.mean(axis=0), bg_lab.std(axis=0) + 1e-3
+
+    matched = (fg_lab - fg_mean) * (bg_std / fg_std) + bg_mean
+    matched = fg_lab + strength * (matched - fg_lab)
+    matched[..., 0] *= 100.0 / 255.0
+    matched[..., 1:] -= 128.0
+    rgb = np.clip(cv2.cvtColor(matched, cv2.COLOR_LAB2RGB), 0.0, 1.0)
+
+    alpha = fg[..., 3:4].astype(np.float32)
+    recolored = fg.copy()
+    recolored[..., :3] = np.clip(rgb * alpha + 0.5, 0, 255).astype(np.uint8)
+    paste_premultiplied(canvas, recolored, x, y)
+
+BLEND_MODES: Dict[str, Callable] = {
+    "alpha": paste_premultiplied,
+    "feather": feather_blend,
+    "laplacian": laplacian_blend,
+    "color_match": color_match_blend,
+}
+
+def get_blend_function(mode: str) -> Callable:
+    if mode not in BLEND_MODES:
+        raise ValueError(f"Unknown blending mode '{mode}'. Use one of: {', '.join(BLEND_MODES)}")
+    return BLEND_MODES[mode]
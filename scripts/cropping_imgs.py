@@ -1,11 +1,14 @@
 import os
 import cv2
+import numpy as np
 from PIL import Image
 import shutil
 import logging
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 import yaml
 
+from scripts.dedup import filter_near_duplicates
+
 def load_config(path = "config.yaml"):
     with open(path,'r') as f:
         return yaml.safe_load(f)
@@ -30,45 +33,83 @@ def yolo_to_pixel_bbox(
 
     return xmin, ymin, xmax, ymax
 
+def yolo_crop_box(
+    x_center: float, y_center: float, width: float, height: float,
+    img_width: int, img_height: int
+) -> Tuple[int, int, int, int]:
+    """
+    Pixel box of a YOLO object clamped to the image, as cropped by crop_yolo_objects.
+    """
+    xmin, ymin, xmax, ymax = yolo_to_pixel_bbox(x_center, y_center, width, height, img_width, img_height)
+    return max(0, xmin), max(0, ymin), min(img_width, xmax), min(img_height, ymax)
+
 def find_mask_for_image(image_filename: str) -> str:
     name, ext = os.path.splitext(image_filename)
     return f"{name}_superpixels.png"
 
 def crop_using_mask(
-    image_path: str, mask_path: str, output_dir: str, base_name: str, min_size: Tuple[int,int] = config["cropping"]["min_size"]
-) -> None:
+    image_path: str, mask_path: str, output_dir: str, base_name: str, min_size: Tuple[int,int] = config["cropping"]["min_size"],
+    foreground_dir: Optional[str] = None,
+    min_pixels: int = config["bg_removal"]["min_foreground_pixels"],
+    class_name: Optional[str] = config["cropping"]["mask_class"]
+) -> List[str]:
+    """
+    Crop every connected component of the image's mask. With foreground_dir set,
+    each crop is saved there as an RGBA foreground whose alpha is the component
+    itself, so it does not need background removal. Components with fewer than
+    min_pixels pixels are skipped, like background-removed crops. Superpixel
+    masks carry no class, so crops are named after class_name; without one
+    they are skipped. Returns the saved paths.
+    """
+    if not class_name:
+        log.warning(f"Skipping mask crops of {image_path}: set cropping.mask_class to use superpixel masks")
+        return []
+
     image = cv2.imread(image_path)
     mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
 
     if image is None or mask is None:
         log.warning(f"Skipping {image_path} - missing image or mask")
-        return
+        return []
 
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    if not contours:
+    num_labels, labels, stats, _ = cv2.connectedComponentsWithStats((mask > 0).astype(np.uint8), connectivity=8)
+    if num_labels <= 1:
         log.warning(f"No objects found in mask for {image_path}")
-        return
+        return []
 
-    for i, contour in enumerate(contours):
-        x, y, w, h = cv2.boundingRect(contour)
-        cropped_img = image[y:y + h, x:x + w]
-        if cropped_img.shape[0] < min_size[1] or cropped_img[1] < min_size[0]:
-            log.info(f"Skipping small crop ({cropped_img.shape[1]},{cropped_img.shape[0]}) from {image_path}")
+    saved = []
+    for label in range(1, num_labels):
+        x, y, w, h = stats[label, :4]
+        if h < min_size[1] or w < min_size[0]:
+            log.info(f"Skipping small crop ({w},{h}) from {image_path}")
             continue
-        output_filename = f"{base_name}_mask_{i}.jpg"
-        output_path = os.path.join(output_dir, output_filename)
-        cv2.imwrite(output_path, cropped_img)
+        if stats[label, cv2.CC_STAT_AREA] < min_pixels:
+            log.info(f"Skipping mask component of {stats[label, cv2.CC_STAT_AREA]} pixels from {image_path}")
+            continue
+        cropped_img = image[y:y + h, x:x + w]
+
+        # Lead with the class name so find_class_id can recover it downstream
+        if foreground_dir is None:
+            output_path = os.path.join(output_dir, f"{class_name}_{base_name}_mask_{label - 1}.jpg")
+            cv2.imwrite(output_path, cropped_img)
+        else:
+            alpha = np.where(labels[y:y + h, x:x + w] == label, 255, 0).astype(np.uint8)
+            output_path = os.path.join(foreground_dir, f"{class_name}_{base_name}_mask_{label - 1}_no_bg.png")
+            cv2.imwrite(output_path, np.dstack((cropped_img, alpha)))
         log.info(f"Saved {output_path}")
+        saved.append(output_path)
+    return saved
 
 def crop_yolo_objects(
     image_path: str, label_path: str, output_dir: str, class_names: List[str], min_size: Tuple[int,int] = config['cropping']['min_size']
-) -> None:
+) -> List[str]:
     img = Image.open(image_path)
     img_width, img_height = img.size
 
     with open(label_path, 'r') as f:
         lines = f.readlines()
 
+    saved = []
     for idx, line in enumerate(lines):
         parts = line.strip().split()
         if len(parts) != 5:
@@ -77,43 +118,67 @@ def crop_yolo_objects(
 
         class_id = int(parts[0])
         x_center, y_center, w, h = map(float, parts[1:])
-        xmin, ymin, xmax, ymax = yolo_to_pixel_bbox(x_center, y_center, w, h, img_width, img_height)
-
-        xmin = max(0, xmin)
-        ymin = max(0, ymin)
-        xmax = min(img_width, xmax)
-        ymax = min(img_height, ymax)
-
-        cropped = img.crop((xmin, ymin, xmax, ymax))
+        cropped = img.crop(yolo_crop_box(x_center, y_center, w, h, img_width, img_height))
         if cropped.width < min_size[0] or cropped.height < min_size[1]:
             log.info(f"Skipping small crop ({cropped.width},{cropped.height}) from {image_path}")
             continue
-        class_name = class_names[class_id]
-        output_filename = f"{os.path.splitext(os.path.basename(image_path))[0]}_mask_{idx}.jpg"
+        # Lead with the class name so find_class_id can recover it downstream
+        prefix = f"{class_names[class_id]}_" if 0 <= class_id < len(class_names) else ""
+        output_filename = f"{prefix}{os.path.splitext(os.path.basename(image_path))[0]}_mask_{idx}.jpg"
         output_path = os.path.join(output_dir, output_filename)
         cropped.save(output_path)
         log.info(f"Saved {output_path}")
+        saved.append(output_path)
+    return saved
+
+def crop_image(
+    image_path: str, labels_dir: str, output_dir: str, class_names: List[str],
+    foreground_dir: Optional[str] = None
+) -> Tuple[List[str], List[str]]:
+    """
+    Crop one image from its YOLO label or superpixel mask. Returns the paths of
+    crops that still need background removal and of RGBA foregrounds that do not.
+    """
+    filename = os.path.basename(image_path)
+    base_name = os.path.splitext(filename)[0]
+    label_path = os.path.join(labels_dir, base_name + ".txt")
+    mask_path = os.path.join(os.path.dirname(image_path), find_mask_for_image(filename))
+
+    if os.path.exists(label_path):
+        return crop_yolo_objects(image_path, label_path, output_dir, class_names), []
+    if os.path.exists(mask_path):
+        saved = crop_using_mask(image_path, mask_path, output_dir, base_name, foreground_dir=foreground_dir)
+        return ([], saved) if foreground_dir is not None else (saved, [])
+    log.warning(f"No YOLO label or mask found for {filename}")
+    return [], []
+
+def is_source_image(filename: str) -> bool:
+    return filename.lower().endswith((".jpg", ".png")) and not filename.endswith("_superpixels.png")
+
+def list_source_images(images_dir: str) -> List[str]:
+    return [
+        os.path.join(images_dir, filename) for filename in sorted(os.listdir(images_dir))
+        if is_source_image(filename)
+    ]
 
 def process_dataset(
-    images_dir: str, labels_dir: str, output_dir: str, class_names: List[str]
+    images_dir: str, labels_dir: str, output_dir: str, class_names: List[str],
+    foreground_dir: Optional[str] = None
 ) -> None:
-    if os.path.exists(output_dir):
-        log.info(f"Clearing previous outputs in {output_dir}...")
-        shutil.rmtree(output_dir)
-    os.makedirs(output_dir, exist_ok=True)
-
-    for filename in os.listdir(images_dir):
-        if not filename.lower().endswith((".jpg", ".png")):
+    """
+    Crop objects from every image using its YOLO label, or its superpixel mask
+    when no label exists. Mask crops are written straight to foreground_dir as
+    RGBA images when it is given, bypassing background removal.
+    """
+    for d in (output_dir, foreground_dir):
+        if d is None:
             continue
+        if os.path.exists(d):
+            log.info(f"Clearing previous outputs in {d}...")
+            shutil.rmtree(d)
+        os.makedirs(d, exist_ok=True)
 
-        image_path = os.path.join(images_dir, filename)
-        label_path = os.path.join(labels_dir, os.path.splitext(filename)[0] + ".txt")
-        mask_path = os.path.join(images_dir, find_mask_for_image(filename))
-        base_name = os.path.splitext(filename)[0]
+    image_paths = filter_near_duplicates(list_source_images(images_dir), stage="cropping")
 
-        if os.path.exists(label_path):
-            crop_yolo_objects(image_path, label_path, output_dir, class_names)
-        elif os.path.exists(mask_path):
-            crop_using_mask(image_path, mask_path, output_dir, base_name)
-        else:
-            log.warning(f"No YOLO label or mask found for {filename}")
+    for image_path in image_paths:
+        crop_image(image_path, labels_dir, output_dir, class_names, foreground_dir)
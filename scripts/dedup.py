@@ -0,0 +1,212 @@
+import os
+import json
+import logging
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+import numpy as np
+from PIL import Image
+import yaml
+
+def load_yaml(path = "config.yaml"):
+    with open(path,'r') as f:
+        return yaml.safe_load(f)
+
+config = load_yaml()
+
+log = logging.getLogger(__name__)
+
+HASH_BITS = 64
+PHASH_SIZE = 32
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2.0)
+    return matrix.astype(np.float32)
+
+_DCT = _dct_matrix(PHASH_SIZE)
+
+def load_thumbnail(path, size) -> np.ndarray:
+    """
+    Grayscale float32 thumbnail of the given (width, height). JPEGs are decoded
+    at reduced scale via draft mode, so full-resolution pixels are never built.
+    """
+    with Image.open(path) as img:
+        img.draft("L", (size[0] * 4, size[1] * 4))
+        return np.asarray(img.convert("L").resize(size, Image.Resampling.BILINEAR), dtype=np.float32)
+
+def _pack_bits(bits: np.ndarray) -> np.ndarray:
+    return np.packbits(bits.reshape(len(bits), HASH_BITS), axis=1).view(">u8").ravel().astype(np.uint64)
+
+def dhash(thumbs: np.ndarray) -> np.ndarray:
+    """
+    64-bit difference hashes of a (N, 8, 9) stack of thumbnails.
+    """
+    return _pack_bits(thumbs[:, :, 1:] > thumbs[:, :, :-1])
+
+def phash(thumbs: np.ndarray) -> np.ndarray:
+    """
+    64-bit DCT hashes of a (N, 32, 32) stack of thumbnails, computed for the
+    whole stack at once as D @ X @ D.T.
+    """
+    low = np.einsum("ij,njk,lk->nil", _DCT[:8], thumbs, _DCT[:8])
+    flat = low.reshape(len(low), HASH_BITS)
+    median = np.median(flat[:, 1:], axis=1, keepdims=True)
+    return _pack_bits(flat > median)
+
+HASH_METHODS = {
+    "dhash": ((9, 8), dhash),
+    "phash": ((PHASH_SIZE, PHASH_SIZE), phash),
+}
+
+def compute_hashes(paths: List[Path], method: str = "dhash") -> Dict[Path, int]:
+    size, hash_fn = HASH_METHODS[method]
+    thumbs, ok = [], []
+    for path in paths:
+        try:
+            thumbs.append(load_thumbnail(path, size))
+            ok.append(path)
+        except Exception as e:
+            log.warning(f"Could not hash {path}: {e}")
+    if not thumbs:
+        return {}
+    return dict(zip(ok, (int(h) for h in hash_fn(np.stack(thumbs)))))
+
+def popcount(values: np.ndarray) -> np.ndarray:
+    values = np.asarray(values, dtype=np.uint64)
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+class HashIndex:
+    """
+    Multi-index hashing over 64-bit hashes. Each hash is split into
+    max_distance + 1 bands; by pigeonhole, any hash within max_distance shares
+    at least one band exactly, so only those candidates are compared.
+    """
+
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        edges = np.linspace(0, HASH_BITS, bands + 1).astype(int)
+        self._bands = [(int(lo), int(hi - lo)) for lo, hi in zip(edges[:-1], edges[1:])]
+        self._tables = [defaultdict(list) for _ in self._bands]
+        self.hashes: List[int] = []
+
+    def _keys(self, value: int):
+        return [(value >> shift) & ((1 << width) - 1) for shift, width in self._bands]
+
+    def query(self, value: int) -> Optional[int]:
+        """
+        Id of the first indexed hash within max_distance of value, or None.
+        """
+        candidates = set()
+        for table, key in zip(self._tables, self._keys(value)):
+            candidates.update(table.get(key, ()))
+        if not candidates:
+            return None
+        ids = np.fromiter(sorted(candidates), dtype=np.int64)
+        stored = np.array([self.hashes[i] for i in ids], dtype=np.uint64)
+        distances = popcount(stored ^ np.uint64(value))
+        close = np.flatnonzero(distances <= self.max_distance)
+        return int(ids[close[0]]) if close.size else None
+
+    def add(self, value: int) -> int:
+        idx = len(self.hashes)
+        self.hashes.append(value)
+        for table, key in zip(self._tables, self._keys(value)):
+            table[key].append(idx)
+        return idx
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+class HashCache:
+    """
+    Hashes persisted across runs in a JSON file, keyed by method and absolute
+    path and invalidated when the file's size or mtime changes.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = {}
+        if self.path.exists():
+            try:
+                with self.path.open('r') as f:
+                    self.entries = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                log.warning(f"Ignoring unreadable hash cache {self.path}: {e}")
+
+    @staticmethod
+    def _stamp(path: Path) -> List[int]:
+        stat = path.stat()
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def get(self, method: str, path: Path) -> Optional[int]:
+        entry = self.entries.get(method, {}).get(str(path.resolve()))
+        if entry is None or entry[:2] != self._stamp(path):
+            return None
+        return int(entry[2], 16)
+
+    def put(self, method: str, path: Path, value: int) -> None:
+        self.entries.setdefault(method, {})[str(path.resolve())] = self._stamp(path) + [f"{value:016x}"]
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        with tmp.open('w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+
+def filter_near_duplicates(
+    paths: List,
+    stage: str,
+    method: str = None,
+    max_distance: int = None,
+    cache_path: str = None
+) -> List:
+    """
+    Return paths with near-duplicates removed, keeping the first of each group
+    in the given order. Disabled (returns paths unchanged) unless
+    config.yaml > dedup.enabled.
+    """
+    dedup = config["dedup"]
+    if not dedup["enabled"] or len(paths) < 2:
+        return list(paths)
+    method = method or dedup["method"]
+    max_distance = dedup["max_distance"] if max_distance is None else max_distance
+    cache = HashCache(cache_path or os.path.join(config["data_root"], dedup["cache"]))
+
+    hashes, missing = {}, []
+    for path in map(Path, paths):
+        cached = cache.get(method, path)
+        if cached is None:
+            missing.append(path)
+        else:
+            hashes[path] = cached
+    computed = compute_hashes(missing, method)
+    for path, value in computed.items():
+        cache.put(method, path, value)
+        hashes[path] = value
+    if computed:
+        cache.save()
+
+    index = HashIndex(max_distance)
+    kept = []
+    for original in paths:
+        value = hashes.get(Path(original))
+        if value is not None:
+            if index.query(value) is not None:
+                continue
+            index.add(value)
+        kept.append(original)
+
+    dropped = len(paths) - len(kept)
+    log.log(
+        logging.WARNING if dropped else logging.INFO,
+        f"Dedup [{stage}]: dropped {dropped} near-duplicates of {len(paths)} "
+        f"({method}, max distance {max_distance}; {len(computed)} hashed, {len(paths) - len(missing)} from cache)"
+    )
+    return kept
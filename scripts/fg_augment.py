@@ -0,0 +1,101 @@
+import math
+import random
+import logging
+from collections import OrderedDict
+from typing import Optional, Tuple
+import cv2
+import numpy as np
+
+from scripts.foreground_atlas import ForegroundAtlas, alpha_bbox
+
+log = logging.getLogger(__name__)
+
+Transform = Tuple[float, float, bool, bool]  # (scale, angle, hflip, vflip)
+
+IDENTITY: Transform = (1.0, 0.0, False, False)
+
+def quantize(value: float, step: float) -> float:
+    if not step:
+        return value
+    return round(round(value / step) * step, 6)
+
+def sample_transform(rng: random.Random, augment: dict) -> Transform:
+    """
+    Draw a transform from the overlay.augment ranges, quantized to
+    scale_step / angle_step so that repeat draws hit the same cache entry.
+    """
+    scale = quantize(rng.uniform(*augment["scale"]), augment["scale_step"])
+    angle = quantize(rng.uniform(*augment["rotation"]), augment["angle_step"])
+    hflip = augment["flip"] and rng.random() < 0.5
+    vflip = augment["flip"] and rng.random() < 0.5
+    return scale, angle, hflip, vflip
+
+def warp_foreground(fg: np.ndarray, transform: Transform) -> Optional[np.ndarray]:
+    """
+    Scale, rotate and flip a premultiplied RGBA foreground in a single
+    cv2.warpAffine over all four channels, then trim it to its new alpha
+    bounding box. Returns None if nothing visible is left.
+    """
+    scale, angle, hflip, vflip = transform
+    h, w = fg.shape[:2]
+    theta = math.radians(angle)
+    sx = -scale if hflip else scale
+    sy = -scale if vflip else scale
+
+    linear = np.array([
+        [math.cos(theta) * sx, math.sin(theta) * sy],
+        [-math.sin(theta) * sx, math.cos(theta) * sy],
+    ])
+    corners = np.array([[0, 0], [w, 0], [0, h], [w, h]], dtype=np.float64) @ linear.T
+    origin = corners.min(axis=0)
+    out_w, out_h = np.ceil(corners.max(axis=0) - origin - 1e-6).astype(int)
+    if out_w < 1 or out_h < 1:
+        return None
+
+    # Map pixel centres rather than corners so flips and right-angle rotations are exact.
+    offset = linear @ np.array([0.5, 0.5]) - origin - 0.5
+    matrix = np.hstack([linear, offset[:, None]])
+    warped = cv2.warpAffine(fg, matrix, (int(out_w), int(out_h)), flags=cv2.INTER_LINEAR,
+                            borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    bbox = alpha_bbox(warped[..., 3])
+    if bbox is None:
+        return None
+    xmin, ymin, xmax, ymax = bbox
+    return np.ascontiguousarray(warped[ymin:ymax, xmin:xmax])
+
+class TransformCache:
+    """
+    LRU cache of transformed foreground variants keyed by
+    (atlas index, quantized transform).
+    """
+
+    def __init__(self, atlas: ForegroundAtlas, max_entries: int = 2048):
+        self.atlas = atlas
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, idx: int, transform: Transform) -> Optional[np.ndarray]:
+        if transform == IDENTITY:
+            return self.atlas.get(idx)
+
+        key = (idx, transform)
+        variant = self._entries.get(key)
+        if variant is not None or key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return variant
+
+        self.misses += 1
+        variant = warp_foreground(self.atlas.get(idx), transform)
+        self._entries[key] = variant
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return variant
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
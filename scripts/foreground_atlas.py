@@ -0,0 +1,152 @@
+import os
+import logging
+from typing import List, Optional
+from multiprocessing import shared_memory
+import numpy as np
+from PIL import Image
+
+log = logging.getLogger(__name__)
+
+def find_class_id(filename: str, class_names: List[str]) -> int:
+    lower_name = filename.lower()
+    for idx, class_name in enumerate(class_names):
+        if class_name.lower() in lower_name:
+            return idx
+    log.warning(f"Class not found in filename '{filename}', defaulting to class 0")
+    return 0
+
+def alpha_bbox(alpha: np.ndarray) -> Optional[tuple]:
+    """
+    Tight (xmin, ymin, xmax, ymax) box around the non-transparent pixels, or None.
+    """
+    rows = np.flatnonzero(alpha.any(axis=1))
+    if rows.size == 0:
+        return None
+    cols = np.flatnonzero(alpha.any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+def premultiply(rgba: np.ndarray) -> np.ndarray:
+    alpha = rgba[..., 3:4].astype(np.uint16)
+    out = rgba.copy()
+    out[..., :3] = (rgba[..., :3].astype(np.uint16) * alpha + 127) // 255
+    return out
+
+def load_foreground(path: str) -> Optional[np.ndarray]:
+    """
+    Decode an RGBA foreground, trim it to its alpha bounding box and
+    premultiply it. Returns None if it is unreadable or fully transparent.
+    """
+    filename = os.path.basename(path)
+    try:
+        rgba = np.asarray(Image.open(path).convert("RGBA"))
+    except Exception as e:
+        log.warning(f"Skipping foreground {filename}: {e}")
+        return None
+
+    bbox = alpha_bbox(rgba[..., 3])
+    if bbox is None:
+        log.warning(f"Skipping fully transparent foreground {filename}")
+        return None
+    xmin, ymin, xmax, ymax = bbox
+    return premultiply(rgba[ymin:ymax, xmin:xmax])
+
+class ForegroundAtlas:
+    """
+    All foregrounds of a run, trimmed to their alpha bounding box and stored
+    premultiplied in one contiguous RGBA buffer. Foreground i is a zero-copy
+    (h, w, 4) view at offsets[i].
+    """
+
+    def __init__(self, names, class_ids, shapes, offsets, buffer, shm=None, owner=True):
+        self.names = list(names)
+        self.class_ids = np.asarray(class_ids, dtype=np.int32)
+        self.shapes = np.asarray(shapes, dtype=np.int64).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.buffer = buffer
+        self._shm = shm
+        self._owner = owner
+
+    @classmethod
+    def from_arrays(cls, names: List[str], class_ids: List[int], arrays: List[np.ndarray]) -> "ForegroundAtlas":
+        shapes = [a.shape[:2] for a in arrays]
+        offsets = np.cumsum([0] + [a.size for a in arrays[:-1]]) if arrays else []
+        buffer = np.concatenate([a.reshape(-1) for a in arrays]) if arrays else np.zeros(0, dtype=np.uint8)
+        return cls(names, class_ids, shapes, offsets, buffer)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def get(self, idx: int) -> np.ndarray:
+        h, w = self.shapes[idx]
+        start = self.offsets[idx]
+        return self.buffer[start:start + h * w * 4].reshape(h, w, 4)
+
+    @property
+    def nbytes(self) -> int:
+        return self.buffer.nbytes
+
+    def share(self) -> dict:
+        """
+        Move the buffer into shared memory and return a picklable handle that
+        worker processes pass to ForegroundAtlas.attach. Call close() once all
+        workers are done.
+        """
+        if self._shm is None:
+            shm = shared_memory.SharedMemory(create=True, size=max(self.buffer.nbytes, 1))
+            shared = np.ndarray(self.buffer.shape, dtype=np.uint8, buffer=shm.buf)
+            shared[:] = self.buffer
+            self.buffer = shared
+            self._shm = shm
+        return {
+            "shm_name": self._shm.name,
+            "size": self.buffer.size,
+            "names": self.names,
+            "class_ids": self.class_ids,
+            "shapes": self.shapes,
+            "offsets": self.offsets,
+        }
+
+    @classmethod
+    def attach(cls, handle: dict) -> "ForegroundAtlas":
+        try:
+            shm = shared_memory.SharedMemory(name=handle["shm_name"], track=False)
+        except TypeError:
+            # Python < 3.13: pool workers share the parent's resource tracker, so
+            # the duplicate registration is harmless.
+            shm = shared_memory.SharedMemory(name=handle["shm_name"])
+        buffer = np.ndarray((handle["size"],), dtype=np.uint8, buffer=shm.buf)
+        return cls(handle["names"], handle["class_ids"], handle["shapes"], handle["offsets"], buffer, shm, owner=False)
+
+    def close(self) -> None:
+        if self._shm is None:
+            return
+        self.buffer = self.buffer.copy() if self._owner else None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+
+def build_foreground_atlas(
+    foregrounds_dir: str,
+    class_names: List[str],
+    extensions: List[str] = None
+) -> ForegroundAtlas:
+    """
+    Decode every foreground in foregrounds_dir once, trim it to its alpha
+    bounding box and pack it into a ForegroundAtlas.
+    """
+    if extensions is None:
+        extensions = ['.png', '.jpg', '.jpeg']
+
+    names, arrays = [], []
+    for filename in sorted(os.listdir(foregrounds_dir)):
+        if os.path.splitext(filename)[1].lower() not in extensions:
+            continue
+        trimmed = load_foreground(os.path.join(foregrounds_dir, filename))
+        if trimmed is not None:
+            names.append(filename)
+            arrays.append(trimmed)
+
+    atlas = ForegroundAtlas.from_arrays(names, [find_class_id(n, class_names) for n in names], arrays)
+    log.info(f"Foreground atlas: {len(atlas)} foregrounds, {atlas.nbytes / 1e6:.1f} MB")
+    return atlas
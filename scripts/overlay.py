@@ -1,10 +1,22 @@
 import os
+import glob
+import time
 import random
 import logging
-from typing import List
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, List, Optional, Tuple
+import numpy as np
 from PIL import Image
 import yaml
 
+from scripts.foreground_atlas import ForegroundAtlas, build_foreground_atlas
+from scripts.fg_augment import TransformCache, sample_transform
+from scripts.dedup import filter_near_duplicates
+from scripts.profiling import profile_worker
+from scripts.scheduler import QuotaScheduler, resolve_class_targets
+from scripts.blending import BLEND_MODES, get_blend_function, paste_premultiplied
+
 def load_yaml(path = "config.yaml"):
     with open(path,'r') as f:
         return yaml.safe_load(f)
@@ -13,6 +25,9 @@ config = load_yaml()
 
 log = logging.getLogger(__name__)
 
+# Foreground pixels at least this opaque belong to the lesion's instance mask
+INSTANCE_ALPHA_THRESHOLD = 128
+
 def ensure_dir(dir_path: str) -> None:
     if not os.path.exists(dir_path):
         os.makedirs(dir_path)
@@ -25,14 +40,6 @@ def get_image_files(directory: str, extensions: List[str] = None) -> List[str]:
         if os.path.splitext(f)[1].lower() in extensions
     ])
 
-def find_class_id(filename: str, class_names: List[str]) -> int:
-    lower_name = filename.lower()
-    for idx, class_name in enumerate(class_names):
-        if class_name.lower() in lower_name:
-            return idx
-    log.warning(f"Class not found in filename '{filename}', defaulting to class 0")
-    return 0
-
 def calculate_iou(boxA, boxB):
     xA = max(boxA[0], boxB[0])
     yA = max(boxA[1], boxB[1])
@@ -56,6 +63,235 @@ def boxes_overlap(boxA, boxB):
         boxA[1] >= boxB[3]
     )
 
+def compose(
+    background: np.ndarray,
+    atlas: ForegroundAtlas,
+    fg_indices: List[int],
+    max_attempts: int,
+    rng: random.Random,
+    padding: int = 10,
+    transforms: Optional[TransformCache] = None,
+    augment: Optional[dict] = None,
+    blend: Callable = paste_premultiplied,
+    blend_params: Optional[dict] = None,
+    instance_map: Optional[np.ndarray] = None
+) -> Tuple[np.ndarray, List[str]]:
+    """
+    Place the given atlas foregrounds on a copy of background without overlap.
+    When transforms is given, each foreground is drawn as a cached
+    scale/rotation/flip variant sampled from augment. blend is one of the
+    functions in scripts.blending.BLEND_MODES. If instance_map (an (h, w)
+    uint8 array of zeros) is given, the alpha of the k-th placed lesion is
+    marked there with id k.
+    Returns the composite and its YOLO annotation lines.
+    """
+    composite = background.copy()
+    bg_height, bg_width = composite.shape[:2]
+    annotation_lines = []
+    occupied_boxes = []
+
+    for idx in fg_indices:
+        if transforms is not None:
+            fg_img = transforms.get(idx, sample_transform(rng, augment))
+            if fg_img is None:
+                continue
+        else:
+            fg_img = atlas.get(idx)
+        fg_height, fg_width = fg_img.shape[:2]
+
+        if fg_width > bg_width or fg_height > bg_height:
+            log.warning("Skipping %s because it is larger than the background.", atlas.names[idx])
+            continue
+
+        placed = False
+        for _ in range(max_attempts):
+            x = rng.randint(0, max(bg_width - fg_width, 0))
+            y = rng.randint(0, max(bg_height - fg_height, 0))
+            new_box = (x-padding, y-padding, x + fg_width + padding, y + fg_height + padding)
+
+            overlap = any(boxes_overlap(new_box, box) for box in occupied_boxes)
+            if not overlap:
+                occupied_boxes.append(new_box)
+                placed = True
+                break
+
+        if not placed:
+            log.warning("Could not place %s without excessive overlap after %d attempts", atlas.names[idx], max_attempts)
+            continue
+
+        blend(composite, fg_img, x, y, blend_params)
+        if instance_map is not None:
+            region = instance_map[y:y + fg_height, x:x + fg_width]
+            region[fg_img[..., 3] >= INSTANCE_ALPHA_THRESHOLD] = len(annotation_lines) + 1
+
+        x_center = (x + fg_width / 2) / bg_width
+        y_center = (y + fg_height / 2) / bg_height
+        width_norm = fg_width / bg_width
+        height_norm = fg_height / bg_height
+        annotation_lines.append(f"{atlas.class_ids[idx]} {x_center:.6f} {y_center:.6f} {width_norm:.6f} {height_norm:.6f}")
+
+    return composite, annotation_lines
+
+_worker_state = {}
+
+def _init_worker(atlas_handle: dict) -> None:
+    profile_worker("overlay")
+    _worker_state["atlas"] = ForegroundAtlas.attach(atlas_handle)
+
+def _render_job(job: tuple, atlas: Optional[ForegroundAtlas] = None) -> List[int]:
+    """
+    Render and save one composite. Returns the class ids of the lesions placed
+    (empty if none were, in which case nothing is written).
+    """
+    bg_path, fg_indices, composite_path, annotation_path, instance_path, max_attempts, seed = job[:7]
+    if atlas is None:
+        atlas = _worker_state["atlas"]
+
+    # Jobs arrive grouped by background, so each background is decoded once per worker.
+    if _worker_state.get("bg_path") != bg_path:
+        log.info("Processing background: %s", os.path.basename(bg_path))
+        _worker_state["bg_image"] = np.asarray(Image.open(bg_path).convert("RGB"))
+        _worker_state["bg_path"] = bg_path
+
+    augment = config['overlay']['augment']
+    transforms = None
+    if augment['enabled']:
+        if "transforms" not in _worker_state:
+            _worker_state["transforms"] = TransformCache(atlas, augment['cache_size'])
+        transforms = _worker_state["transforms"]
+
+    blending = config['overlay']['blending']
+    background = _worker_state["bg_image"]
+    instance_map = np.zeros(background.shape[:2], dtype=np.uint8) if instance_path else None
+    composite, annotation_lines = compose(
+        background, atlas, fg_indices, max_attempts, random.Random(seed),
+        transforms=transforms, augment=augment,
+        blend=get_blend_function(blending['mode']), blend_params=blending,
+        instance_map=instance_map
+    )
+    if not annotation_lines:
+        log.info("No lesions placed on background %s, skipping composite.", os.path.basename(bg_path))
+        return []
+
+    return save_composite(composite, annotation_lines, composite_path, annotation_path, instance_map, instance_path)
+
+def instance_map_path(instances_dir: Optional[str], composite_path: str) -> Optional[str]:
+    if not instances_dir:
+        return None
+    return os.path.join(instances_dir, os.path.splitext(os.path.basename(composite_path))[0] + ".png")
+
+def clear_composite_outputs(composites_dir: str, annotations_dir: str, instances_dir: Optional[str] = None) -> None:
+    """
+    Remove the composites, YOLO labels and instance maps of a previous run so
+    none of them is left behind to be paired with this run's files. Copied
+    originals (orig_*) are kept.
+    """
+    stale = 0
+    for directory, pattern in ((composites_dir, "composite_*"), (annotations_dir, "composite_*.txt"), (instances_dir, "*.png")):
+        if directory and os.path.isdir(directory):
+            for path in glob.glob(os.path.join(directory, pattern)):
+                os.remove(path)
+                stale += 1
+    if stale:
+        log.info("Cleared %d composite outputs of a previous run.", stale)
+
+def save_composite(
+    composite: np.ndarray,
+    annotation_lines: List[str],
+    composite_path: str,
+    annotation_path: str,
+    instance_map: Optional[np.ndarray] = None,
+    instance_path: Optional[str] = None
+) -> List[int]:
+    Image.fromarray(composite).save(composite_path)
+    with open(annotation_path, 'w') as f:
+        f.write("\n".join(annotation_lines))
+    if instance_map is not None and instance_path:
+        Image.fromarray(instance_map).save(instance_path)
+    return [int(line.split()[0]) for line in annotation_lines]
+
+class CompositeNumbering:
+    """
+    Gap-free composite names for jobs that finish out of order or place
+    nothing. Jobs render under a pending name; publish() moves the files of a
+    job that placed lesions to the next free composite_<n>.
+    """
+
+    def __init__(self, composites_dir: str, annotations_dir: str, instances_dir: Optional[str], start_index: int):
+        self.composites_dir = composites_dir
+        self.annotations_dir = annotations_dir
+        self.instances_dir = instances_dir
+        self.next_index = start_index
+        self._jobs = 0
+        self._pending = set()
+
+    def pending_paths(self) -> Tuple[str, str, Optional[str]]:
+        self._jobs += 1
+        name = f"pending_{os.getpid()}_{self._jobs}"
+        composite_path = os.path.join(self.composites_dir, name + ".jpg")
+        paths = (composite_path, os.path.join(self.annotations_dir, name + ".txt"), instance_map_path(self.instances_dir, composite_path))
+        self._pending.add(paths)
+        return paths
+
+    def publish(self, job: tuple, placed: List[int]) -> None:
+        paths = tuple(job[2:5])
+        self._pending.discard(paths)
+        if not placed:
+            return
+        composite_path = os.path.join(self.composites_dir, f"composite_{self.next_index}.jpg")
+        os.replace(paths[0], composite_path)
+        os.replace(paths[1], os.path.join(self.annotations_dir, f"composite_{self.next_index}.txt"))
+        if paths[2]:
+            os.replace(paths[2], instance_map_path(self.instances_dir, composite_path))
+        log.info("Saved composite: %s", composite_path)
+        self.next_index += 1
+
+    def discard_pending(self) -> None:
+        """Remove files of jobs that never completed, e.g. after an error."""
+        for paths in self._pending:
+            for path in paths:
+                if path and os.path.exists(path):
+                    os.remove(path)
+        self._pending.clear()
+
+def run_jobs(
+    next_job: Callable[[], Optional[tuple]],
+    on_done: Callable[[tuple, List[int]], None],
+    atlas: ForegroundAtlas,
+    workers: int
+) -> None:
+    """
+    Pull jobs from next_job until it returns None and render them, in process or
+    on a worker pool with at most 2 * workers jobs in flight. Jobs are only
+    created when a slot frees up, so next_job can react to earlier results
+    passed to on_done.
+    """
+    if workers <= 1:
+        job = next_job()
+        while job is not None:
+            on_done(job, _render_job(job, atlas))
+            job = next_job()
+        return
+
+    # Workers are spawned, not forked: forking after rembg has loaded numba
+    # leaves the parent hanging at exit. They attach to the atlas by name.
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker, initargs=(atlas.share(),)
+    ) as executor:
+        in_flight = {}
+        while True:
+            while len(in_flight) < 2 * workers:
+                job = next_job()
+                if job is None:
+                    break
+                in_flight[executor.submit(_render_job, job)] = job
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                on_done(in_flight.pop(future), future.result())
+
 def overlay_foreground_on_background(
     foregrounds_dir: str,
     backgrounds_dir: str,
@@ -64,84 +300,188 @@ def overlay_foreground_on_background(
     class_names: List[str],
     lesions_per_image: int = config['overlay']['no_of_lesions'],
     max_attempts: int = 20,
-) -> None:
+    atlas: Optional[ForegroundAtlas] = None,
+    start_index: int = 1,
+    workers: int = config['overlay']['workers'],
+    instances_dir: Optional[str] = None,
+) -> int:
+    """
+    Composite batches of foregrounds onto every background in backgrounds_dir.
+
+    Pass a prebuilt atlas to reuse decoded foregrounds across calls. Composites
+    are numbered from start_index without gaps (jobs that place no lesion take
+    no number); the next free index is returned so several background sources
+    can write into the same output folders. With
+    instances_dir, a per-lesion instance id map is saved for each composite.
+    """
     ensure_dir(composites_dir)
     ensure_dir(annotations_dir)
+    if instances_dir:
+        ensure_dir(instances_dir)
 
-    foreground_files = get_image_files(foregrounds_dir)
+    own_atlas = atlas is None
+    if own_atlas:
+        atlas = build_foreground_atlas(foregrounds_dir, class_names)
     background_files = get_image_files(backgrounds_dir)
 
-    if not foreground_files:
+    if not len(atlas):
         log.error("No foreground images found in %s", foregrounds_dir)
-        return
+        return start_index
     if not background_files:
         log.error("No background images found in %s", backgrounds_dir)
-        return
+        return start_index
 
-    lesion_batches = [foreground_files[i:i + lesions_per_image] for i in range(0, len(foreground_files), lesions_per_image)]
-    composite_count = 1
-
-    for bg_file in background_files:
-        bg_path = os.path.join(backgrounds_dir, bg_file)
-        bg_img = Image.open(bg_path).convert("RGBA")
-        bg_width, bg_height = bg_img.size
-        log.info("Processing background: %s", bg_file)
-
-        for batch_num, lesion_batch in enumerate(lesion_batches):
-            composite = bg_img.copy()
-            annotation_lines = []
-            occupied_boxes = []
-
-            placed_count = 0
-            for fg_file in lesion_batch:
-                fg_path = os.path.join(foregrounds_dir, fg_file)
-                fg_img = Image.open(fg_path).convert("RGBA")
-                fg_width, fg_height = fg_img.size
-
-                if fg_width > bg_width or fg_height > bg_height:
-                    log.warning("Skipping %s because it is larger than the background.", fg_file)
-                    continue
-
-                class_id = find_class_id(fg_file, class_names)
-
-                placed = False
-                for _ in range(max_attempts):
-                    x = random.randint(0, max(bg_width - fg_width, 0))
-                    y = random.randint(0, max(bg_height - fg_height, 0))
-                    padding = 10
-                    new_box = (x-padding, y-padding, x + fg_width + padding, y + fg_height + padding)
-
-                    overlap = any(boxes_overlap(new_box, box) for box in occupied_boxes)
-                    if not overlap:
-                        occupied_boxes.append(new_box)
-                        placed = True
-                        break
-
-                if not placed:
-                    log.warning("Could not place %s without excessive overlap after %d attempts", fg_file, max_attempts)
-                    continue
-
-                composite.alpha_composite(fg_img, dest=(x, y))
-
-                x_center = (x + fg_width / 2) / bg_width
-                y_center = (y + fg_height / 2) / bg_height
-                width_norm = fg_width / bg_width
-                height_norm = fg_height / bg_height
-                annotation_lines.append(f"{class_id} {x_center:.6f} {y_center:.6f} {width_norm:.6f} {height_norm:.6f}")
-                placed_count += 1
-
-            if placed_count == 0:
-                log.info("No lesions placed on background %s, skipping composite.", bg_file)
-                continue
+    lesion_batches = [list(range(i, min(i + lesions_per_image, len(atlas)))) for i in range(0, len(atlas), lesions_per_image)]
+
+    unique_backgrounds = filter_near_duplicates(
+        [os.path.join(backgrounds_dir, f) for f in background_files], stage="backgrounds"
+    )
+    if len(unique_backgrounds) < len(background_files):
+        log.info("Near-duplicate backgrounds dropped; %d composites not generated.",
+                 (len(background_files) - len(unique_backgrounds)) * len(lesion_batches))
+    background_files = [os.path.basename(p) for p in unique_backgrounds]
+
+    numbering = CompositeNumbering(composites_dir, annotations_dir, instances_dir, start_index)
+
+    def iter_jobs():
+        for bg_file in background_files:
+            bg_path = os.path.join(backgrounds_dir, bg_file)
+            for lesion_batch in lesion_batches:
+                yield (bg_path, lesion_batch, *numbering.pending_paths(), max_attempts, random.getrandbits(32))
 
-            composite_filename = f"composite_{composite_count}.jpg"
-            composite_path = os.path.join(composites_dir, composite_filename)
-            composite.convert("RGB").save(composite_path)
-            log.info("Saved composite: %s", composite_path)
+    jobs = iter_jobs()
+    try:
+        run_jobs(lambda: next(jobs, None), numbering.publish, atlas, workers)
+    finally:
+        numbering.discard_pending()
+        _worker_state.clear()
+        if own_atlas:
+            atlas.close()
 
-            annotation_path = os.path.join(annotations_dir, f"composite_{composite_count}.txt")
-            with open(annotation_path, 'w') as f:
-                f.write("\n".join(annotation_lines))
-            composite_count += 1
+    log.info("All composites and annotations generated successfully! (%d written)", numbering.next_index - start_index)
+    return numbering.next_index
+
+def overlay_with_quotas(
+    atlas: ForegroundAtlas,
+    backgrounds_dirs: List[str],
+    composites_dir: str,
+    annotations_dir: str,
+    class_names: List[str],
+    class_targets: dict = config['overlay']['quotas']['class_targets'],
+    budget: int = config['overlay']['quotas']['budget'],
+    lesions_per_image: int = config['overlay']['no_of_lesions'],
+    max_attempts: int = 20,
+    start_index: int = 1,
+    workers: int = config['overlay']['workers'],
+    instances_dir: Optional[str] = None,
+) -> int:
+    """
+    Generate composites until each class in class_targets (lesion instances per
+    class name) is met or budget composites have been issued, sampling
+    foreground/background pairings with QuotaScheduler instead of crossing
+    every lesion batch with every background. Returns the next free index.
+    """
+    ensure_dir(composites_dir)
+    ensure_dir(annotations_dir)
+    if instances_dir:
+        ensure_dir(instances_dir)
+
+    background_paths = []
+    for backgrounds_dir in backgrounds_dirs:
+        if os.path.exists(backgrounds_dir):
+            background_paths += [os.path.join(backgrounds_dir, f) for f in get_image_files(backgrounds_dir)]
+    background_paths = filter_near_duplicates(background_paths, stage="backgrounds")
+
+    if not len(atlas) or not background_paths:
+        log.error("Quota overlay needs at least one foreground and one background.")
+        return start_index
+
+    scheduler = QuotaScheduler(
+        atlas, background_paths, resolve_class_targets(class_targets, class_names),
+        budget, lesions_per_image, random.Random()
+    )
+    numbering = CompositeNumbering(composites_dir, annotations_dir, instances_dir, start_index)
+
+    def next_job():
+        spec = scheduler.next_job()
+        if spec is None:
+            return None
+        bg_path, fg_indices, planned = spec
+        return (bg_path, fg_indices, *numbering.pending_paths(), max_attempts, scheduler.rng.getrandbits(32), planned)
+
+    def on_done(job, placed):
+        numbering.publish(job, placed)
+        scheduler.complete(job[-1], placed)
+
+    try:
+        run_jobs(next_job, on_done, atlas, workers)
+    finally:
+        numbering.discard_pending()
+        _worker_state.clear()
+
+    scheduler.report()
+    return numbering.next_index
+
+def benchmark_augmentation(
+    atlas: ForegroundAtlas,
+    background: np.ndarray,
+    composites: int = 200,
+    lesions_per_image: int = config['overlay']['no_of_lesions'],
+    max_attempts: int = 20
+) -> dict:
+    """
+    Compare composites/sec of the plain paste path against geometric
+    augmentation with the transform cache, on one in-memory background.
+    """
+    augment = config['overlay']['augment']
+    rng = random.Random(0)
+    batches = [rng.sample(range(len(atlas)), min(lesions_per_image, len(atlas))) for _ in range(composites)]
+
+    start = time.perf_counter()
+    for batch in batches:
+        compose(background, atlas, batch, max_attempts, rng)
+    plain_time = time.perf_counter() - start
+
+    transforms = TransformCache(atlas, augment['cache_size'])
+    start = time.perf_counter()
+    for batch in batches:
+        compose(background, atlas, batch, max_attempts, rng, transforms=transforms, augment=augment)
+    augmented_time = time.perf_counter() - start
+
+    report = {
+        "composites": composites,
+        "plain_per_sec": composites / plain_time if plain_time else 0.0,
+        "augmented_per_sec": composites / augmented_time if augmented_time else 0.0,
+        "slowdown": augmented_time / plain_time if plain_time else 0.0,
+        "cache_hit_rate": transforms.hit_rate,
+    }
+    log.info(
+        "Augmentation benchmark: %.1f -> %.1f composites/sec (x%.2f), cache hit rate %.1f%%",
+        report["plain_per_sec"], report["augmented_per_sec"], report["slowdown"], 100 * report["cache_hit_rate"]
+    )
+    return report
+
+def benchmark_blend_modes(
+    atlas: ForegroundAtlas,
+    background: np.ndarray,
+    composites: int = 50,
+    lesions_per_image: int = config['overlay']['no_of_lesions'],
+    max_attempts: int = 20
+) -> dict:
+    """
+    Report the mean per-composite cost in milliseconds of every blending mode,
+    using the same placements for each mode.
+    """
+    blending = config['overlay']['blending']
+    rng = random.Random(0)
+    batches = [rng.sample(range(len(atlas)), min(lesions_per_image, len(atlas))) for _ in range(composites)]
+    seeds = [rng.getrandbits(32) for _ in batches]
 
-    log.info("All composites and annotations generated successfully!")
+    report = {}
+    for mode, blend in BLEND_MODES.items():
+        start = time.perf_counter()
+        for batch, seed in zip(batches, seeds):
+            compose(background, atlas, batch, max_attempts, random.Random(seed), blend=blend, blend_params=blending)
+        report[mode] = 1000 * (time.perf_counter() - start) / composites
+        log.info("Blend mode %-12s %.2f ms/composite", mode, report[mode])
+    return report
@@ -0,0 +1,452 @@
+import os
+import time
+import queue
+import random
+import shutil
+import logging
+import itertools
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+from PIL import Image
+import yaml
+
+from scripts.bg_removal import create_session, remove_bg_file
+from scripts.cropping_imgs import crop_image, list_source_images
+from scripts.dedup import filter_near_duplicates
+from scripts.foreground_atlas import ForegroundAtlas, find_class_id, load_foreground
+from scripts.fg_augment import TransformCache
+from scripts.blending import get_blend_function
+from scripts.overlay import clear_composite_outputs, compose, get_image_files, instance_map_path, save_composite
+from scripts.yolo_to_mask import build_mask
+
+def load_yaml(path = "config.yaml"):
+    with open(path,'r') as f:
+        return yaml.safe_load(f)
+
+config = load_yaml()
+
+log = logging.getLogger(__name__)
+
+_DONE = object()
+
+class MonitoredQueue:
+    """
+    Bounded queue that records its depth on every put, how long producers were
+    blocked because it was full, and how long consumers waited on it empty.
+    """
+
+    def __init__(self, name: str, maxsize: int):
+        self.name = name
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self.puts = 0
+        self.depth_total = 0
+        self.max_depth = 0
+        self.put_stall = 0.0
+        self.get_stall = 0.0
+
+    def put(self, item) -> None:
+        start = time.perf_counter()
+        self._queue.put(item)
+        waited = time.perf_counter() - start
+        depth = self._queue.qsize()
+        with self._lock:
+            self.put_stall += waited
+            if item is not _DONE:
+                self.puts += 1
+                self.depth_total += depth
+                self.max_depth = max(self.max_depth, depth)
+
+    def get(self):
+        start = time.perf_counter()
+        item = self._queue.get()
+        waited = time.perf_counter() - start
+        with self._lock:
+            self.get_stall += waited
+        return item
+
+    def report(self) -> dict:
+        return {
+            "items": self.puts,
+            "mean_depth": self.depth_total / self.puts if self.puts else 0.0,
+            "max_depth": self.max_depth,
+            "producer_stall_s": self.put_stall,
+            "consumer_stall_s": self.get_stall,
+        }
+
+class Stage:
+    """
+    A pipeline stage run by `workers` threads. handler_factory is called once
+    per thread, before any thread starts, and returns an object with
+    process(item, emit) and, optionally, finish(emit), which runs after the
+    input is exhausted.
+    """
+
+    def __init__(self, name: str, handler_factory: Callable, workers: int = 1):
+        self.name = name
+        self.handler_factory = handler_factory
+        self.workers = max(1, workers)
+        self.busy = 0.0
+        self.first_output = None
+        self._lock = threading.Lock()
+        self._running = 0
+
+class Pipeline:
+    """
+    Stages connected by bounded MonitoredQueues. Items flow downstream as soon
+    as they are emitted; when every worker of a stage has finished, the next
+    stage receives one end marker per worker. A worker that fails outside a
+    single item keeps draining its input so the run still ends, and run()
+    re-raises the first such error.
+    """
+
+    def __init__(self, stages: List[Stage], queue_size: int):
+        self.stages = stages
+        self.queues = [MonitoredQueue(f"-> {stage.name}", queue_size) for stage in stages]
+        self.start = None
+        self.errors: List[BaseException] = []
+        self._errors_lock = threading.Lock()
+
+    def _worker(self, idx: int, handler) -> None:
+        stage = self.stages[idx]
+        inbox = self.queues[idx]
+        outbox = self.queues[idx + 1] if idx + 1 < len(self.stages) else None
+
+        # Time spent blocked on a full outbox is downstream backpressure, not work.
+        blocked = [0.0]
+
+        def emit(item):
+            if stage.first_output is None:
+                stage.first_output = time.perf_counter() - self.start
+            if outbox is not None:
+                start = time.perf_counter()
+                outbox.put(item)
+                blocked[0] += time.perf_counter() - start
+
+        exhausted = False
+        try:
+            while True:
+                item = inbox.get()
+                if item is _DONE:
+                    exhausted = True
+                    break
+                start = time.perf_counter()
+                blocked[0] = 0.0
+                try:
+                    handler.process(item, emit)
+                except Exception as e:
+                    log.error(f"[{stage.name}] failed on {item}: {e}")
+                with stage._lock:
+                    stage.busy += time.perf_counter() - start - blocked[0]
+
+            finish = getattr(handler, "finish", None)
+            if finish is not None:
+                try:
+                    finish(emit)
+                except Exception as e:
+                    log.error(f"[{stage.name}] failed to finish: {e}")
+        except BaseException as e:
+            log.exception(f"[{stage.name}] worker failed: {e}")
+            with self._errors_lock:
+                self.errors.append(e)
+        finally:
+            # Upstream must never block on a dead worker, and downstream must
+            # still get its end markers
+            while not exhausted:
+                exhausted = inbox.get() is _DONE
+            with stage._lock:
+                stage._running -= 1
+                last = stage._running == 0
+            if last and outbox is not None:
+                for _ in range(self.stages[idx + 1].workers):
+                    outbox.put(_DONE)
+
+    def run(self, items) -> dict:
+        # Handlers are built before any thread starts, so a bad setting (e.g.
+        # an unknown blend mode or a model that cannot load) fails here
+        handlers = [[stage.handler_factory() for _ in range(stage.workers)] for stage in self.stages]
+
+        self.start = time.perf_counter()
+        self.errors = []
+        threads = []
+        for idx, stage in enumerate(self.stages):
+            stage._running = stage.workers
+            for n, handler in enumerate(handlers[idx]):
+                thread = threading.Thread(target=self._worker, args=(idx, handler), name=f"{stage.name}-{n}", daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        try:
+            for item in items:
+                self.queues[0].put(item)
+        finally:
+            for _ in range(self.stages[0].workers):
+                self.queues[0].put(_DONE)
+
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+        return self.report(time.perf_counter() - self.start)
+
+    def report(self, elapsed: float) -> dict:
+        report = {"elapsed_s": elapsed, "stages": {}}
+        log.info(f"Pipeline finished in {elapsed:.1f}s")
+        for stage, inbox in zip(self.stages, self.queues):
+            stats = inbox.report()
+            stats["workers"] = stage.workers
+            stats["utilization"] = stage.busy / (stage.workers * elapsed) if elapsed else 0.0
+            stats["first_output_s"] = stage.first_output
+            report["stages"][stage.name] = stats
+            first = f"{stage.first_output:.2f}s" if stage.first_output is not None else "-"
+            log.info(
+                f"  {stage.name:<11} workers={stage.workers} util={stats['utilization']:.0%} "
+                f"in={stats['items']} depth(mean/max)={stats['mean_depth']:.1f}/{stats['max_depth']} "
+                f"upstream blocked={stats['producer_stall_s']:.1f}s starved={stats['consumer_stall_s']:.1f}s "
+                f"first output={first}"
+            )
+        bottleneck = max(report["stages"], key=lambda name: report["stages"][name]["utilization"])
+        report["bottleneck"] = bottleneck
+        log.info(f"Bottleneck stage: {bottleneck}")
+        return report
+
+class _CropHandler:
+    def __init__(self, labels_dir, cropped_dir, foregrounds_dir, class_names):
+        self.args = (labels_dir, cropped_dir, class_names, foregrounds_dir)
+
+    def process(self, image_path, emit):
+        labels_dir, cropped_dir, class_names, foregrounds_dir = self.args
+        crops, foregrounds = crop_image(image_path, labels_dir, cropped_dir, class_names, foregrounds_dir)
+        for crop in crops:
+            emit(("crop", crop, image_path))
+        for foreground in foregrounds:
+            emit(("foreground", foreground, image_path))
+
+class _BgRemovalHandler:
+    def __init__(self, foregrounds_dir, session):
+        self.foregrounds_dir = foregrounds_dir
+        self.session = session
+        adaptive = config["bg_removal"]["adaptive"]
+        self.max_side = adaptive["max_inference_side"] if adaptive["enabled"] else None
+        self.refine_edges = adaptive["refine_edges"]
+
+    def process(self, item, emit):
+        kind, path, source = item
+        if kind == "foreground":
+            emit((path, source))
+            return
+        output = remove_bg_file(Path(path), self.foregrounds_dir, self.session, self.max_side, self.refine_edges)
+        if output is not None:
+            emit((str(output), source))
+
+class _CompositeHandler:
+    """
+    Collects foregrounds into batches of lesions_per_image and composites each
+    full batch onto every background as soon as it is complete. Each
+    composite carries the source images its lesions were cropped from.
+    """
+
+    def __init__(self, backgrounds, class_names, lesions_per_image, max_attempts, next_index):
+        self.backgrounds = backgrounds
+        self.class_names = class_names
+        self.lesions_per_image = lesions_per_image
+        self.max_attempts = max_attempts
+        self.next_index = next_index
+        self.batch = []
+        self.rng = random.Random()
+        blending = config["overlay"]["blending"]
+        self.blend = get_blend_function(blending["mode"])
+        self.blend_params = blending
+        self.augment = config["overlay"]["augment"]
+
+    def process(self, item, emit):
+        self.batch.append(item)
+        if len(self.batch) >= self.lesions_per_image:
+            self._render(emit)
+
+    def finish(self, emit):
+        if self.batch:
+            self._render(emit)
+
+    def _render(self, emit):
+        names, arrays, sources = [], [], set()
+        for path, source in self.batch:
+            fg = load_foreground(path)
+            if fg is not None:
+                names.append(os.path.basename(path))
+                arrays.append(fg)
+                sources.add(source)
+        self.batch = []
+        if not arrays:
+            return
+
+        atlas = ForegroundAtlas.from_arrays(names, [find_class_id(n, self.class_names) for n in names], arrays)
+        transforms = TransformCache(atlas, self.augment["cache_size"]) if self.augment["enabled"] else None
+        for bg_name, background in self.backgrounds:
+            instance_map = np.zeros(background.shape[:2], dtype=np.uint8)
+            composite, annotation_lines = compose(
+                background, atlas, list(range(len(atlas))), self.max_attempts, self.rng,
+                transforms=transforms, augment=self.augment, blend=self.blend, blend_params=self.blend_params,
+                instance_map=instance_map
+            )
+            if not annotation_lines:
+                log.info(f"No lesions placed on background {bg_name}, skipping composite.")
+                continue
+            emit((self.next_index(), composite, annotation_lines, instance_map, sources))
+
+class _WriteHandler:
+    def __init__(self, composites_dir, annotations_dir, masks_dir, instances_dir=None, written=None):
+        self.dirs = (composites_dir, annotations_dir, masks_dir)
+        self.instances_dir = instances_dir
+        self.written = written
+
+    def process(self, item, emit):
+        composites_dir, annotations_dir, masks_dir = self.dirs
+        composite_index, composite, annotation_lines, instance_map, sources = item
+        name = f"composite_{composite_index}"
+        annotation_path = os.path.join(annotations_dir, f"{name}.txt")
+        composite_path = os.path.join(composites_dir, f"{name}.jpg")
+        save_composite(
+            composite, annotation_lines, composite_path, annotation_path,
+            instance_map, instance_map_path(self.instances_dir, composite_path)
+        )
+        log.info(f"Saved composite: {composite_path}")
+        h, w = composite.shape[:2]
+        Image.fromarray(build_mask(annotation_path, w, h)).save(os.path.join(masks_dir, f"{name}.png"))
+        if self.written is not None:
+            self.written[f"{name}.jpg"] = sorted(sources)
+        emit(name)
+
+def index_counter(start: int) -> Callable[[], int]:
+    """
+    Thread-safe source of consecutive composite indices starting at start.
+    """
+    lock = threading.Lock()
+    counter = itertools.count(start)
+
+    def next_index():
+        with lock:
+            return next(counter)
+    return next_index
+
+def load_backgrounds(backgrounds_dirs: List[str]) -> List[Tuple[str, np.ndarray]]:
+    """
+    (file name, RGB array) for every distinct background in backgrounds_dirs.
+    """
+    background_paths = []
+    for backgrounds_dir in backgrounds_dirs:
+        if os.path.exists(backgrounds_dir):
+            background_paths += [os.path.join(backgrounds_dir, f) for f in get_image_files(backgrounds_dir)]
+    background_paths = filter_near_duplicates(background_paths, stage="backgrounds")
+    return [(os.path.basename(p), np.asarray(Image.open(p).convert("RGB"))) for p in background_paths]
+
+def warn_unsupported_options() -> None:
+    """
+    Log the config.yaml options a sequential run applies but the pipelined
+    stages do not, so the two modes are not silently producing different
+    datasets.
+    """
+    if config["overlay"]["quotas"]["enabled"]:
+        log.warning(
+            "overlay.quotas is ignored in pipelined mode: every lesion batch is composited onto every "
+            "background. Set pipeline.mode to sequential to use quotas."
+        )
+    if config["dedup"]["enabled"]:
+        log.warning(
+            "dedup in pipelined mode only filters source images and backgrounds; crops are not "
+            "deduplicated before background removal as in sequential mode."
+        )
+
+def build_stages(
+    labels_dir: str,
+    cropped_dir: str,
+    foregrounds_dir: str,
+    backgrounds: List[Tuple[str, np.ndarray]],
+    composites_dir: str,
+    annotations_dir: str,
+    masks_dir: str,
+    class_names: List[str],
+    session_for_worker: Callable[[int], object],
+    next_index: Callable[[], int],
+    lesions_per_image: int = config["overlay"]["no_of_lesions"],
+    max_attempts: int = 20,
+    instances_dir: Optional[str] = None,
+    written: Optional[Dict[str, List[str]]] = None
+) -> List[Stage]:
+    """
+    The crop -> bg_removal -> composite -> write stages. Each bg_removal
+    thread gets session_for_worker(i) for its worker number i. If written is
+    given, each composite written is recorded there by file name, with the
+    paths of the source images its lesions came from.
+    """
+    worker_ids = itertools.count()
+    worker_ids_lock = threading.Lock()
+
+    def bg_removal_handler():
+        with worker_ids_lock:
+            worker = next(worker_ids)
+        return _BgRemovalHandler(foregrounds_dir, session_for_worker(worker))
+
+    workers = config["pipeline"]["workers"]
+    return [
+        Stage("crop", lambda: _CropHandler(labels_dir, cropped_dir, foregrounds_dir, class_names), workers["crop"]),
+        Stage("bg_removal", bg_removal_handler, workers["bg_removal"]),
+        Stage("composite", lambda: _CompositeHandler(backgrounds, class_names, lesions_per_image, max_attempts, next_index), workers["composite"]),
+        Stage("write", lambda: _WriteHandler(composites_dir, annotations_dir, masks_dir, instances_dir, written), workers["write"]),
+    ]
+
+def run_pipelined(
+    images_dir: str,
+    labels_dir: str,
+    cropped_dir: str,
+    foregrounds_dir: str,
+    backgrounds_dirs: List[str],
+    composites_dir: str,
+    annotations_dir: str,
+    masks_dir: str,
+    class_names: List[str],
+    session=None,
+    lesions_per_image: int = config["overlay"]["no_of_lesions"],
+    max_attempts: int = 20,
+    start_index: int = 1,
+    instances_dir: Optional[str] = None
+) -> dict:
+    """
+    Run crop -> background removal -> composite -> write (composite, YOLO
+    label and mask) as concurrent stages connected by bounded queues, with
+    worker counts from config.yaml > pipeline.workers. Foregrounds are
+    composited onto the in-memory background pool as soon as a batch of
+    lesions_per_image is ready. Returns per-stage queue and stall metrics.
+    overlay.quotas and the bg_removal dedup pass are not supported here.
+    """
+    warn_unsupported_options()
+    for d in (cropped_dir, foregrounds_dir):
+        if os.path.exists(d):
+            log.info(f"Clearing previous outputs in {d}...")
+            shutil.rmtree(d)
+        os.makedirs(d, exist_ok=True)
+    for d in (composites_dir, annotations_dir, masks_dir, instances_dir):
+        if d:
+            os.makedirs(d, exist_ok=True)
+    clear_composite_outputs(composites_dir, annotations_dir, instances_dir)
+    for mask_file in Path(masks_dir).glob("*.png"):
+        mask_file.unlink()
+
+    backgrounds = load_backgrounds(backgrounds_dirs)
+    if not backgrounds:
+        log.error("No background images found, nothing to composite.")
+        return {}
+
+    # One onnxruntime session per bg_removal worker, each with its own
+    # thread/affinity settings, unless a shared session is passed in
+    def session_for_worker(worker):
+        return session if session is not None else create_session(worker=worker)
+
+    stages = build_stages(
+        labels_dir, cropped_dir, foregrounds_dir, backgrounds, composites_dir, annotations_dir, masks_dir,
+        class_names, session_for_worker, index_counter(start_index), lesions_per_image, max_attempts, instances_dir
+    )
+    images = filter_near_duplicates(list_source_images(images_dir), stage="cropping")
+    return Pipeline(stages, config["pipeline"]["queue_size"]).run(images)
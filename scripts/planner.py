@@ -0,0 +1,410 @@
+import os
+import json
+import math
+import time
+import random
+import logging
+import tempfile
+from pathlib import Path
+from typing import List, Optional, Tuple
+import cv2
+import numpy as np
+from PIL import Image
+import yaml
+
+from scripts.bg_removal import create_session, remove_bg_file
+from scripts.cropping_imgs import crop_image, find_mask_for_image, list_source_images, yolo_crop_box
+from scripts.dedup import filter_near_duplicates
+from scripts.foreground_atlas import ForegroundAtlas, find_class_id, load_foreground
+from scripts.fg_augment import TransformCache
+from scripts.blending import get_blend_function
+from scripts.overlay import compose, get_image_files, save_composite
+from scripts.scheduler import resolve_class_targets
+from scripts.yolo_to_json import add_coco_images, empty_coco
+from scripts.yolo_to_mask import build_mask
+
+def load_yaml(path = "config.yaml"):
+    with open(path,'r') as f:
+        return yaml.safe_load(f)
+
+config = load_yaml()
+
+log = logging.getLogger(__name__)
+
+def image_size(path: str) -> Optional[Tuple[int, int]]:
+    """
+    (width, height) from the image header, without decoding pixels.
+    """
+    try:
+        with Image.open(path) as img:
+            return img.size
+    except Exception as e:
+        log.warning(f"Could not read header of {path}: {e}")
+        return None
+
+def scan_sources(images_dir: str, labels_dir: str, min_size=config["cropping"]["min_size"]) -> dict:
+    """
+    Exact crop counts of the cropping stage for the images in images_dir:
+    YOLO crops (which go through background removal) and superpixel-mask
+    foregrounds (which do not), with their total pixel areas. Images are read
+    header-only; only superpixel masks are decoded, for their components.
+    """
+    images = filter_near_duplicates(list_source_images(images_dir), stage="cropping") if os.path.isdir(images_dir) else []
+    scan = {
+        "images": len(images), "image_bytes": 0, "image_pixels": 0, "label_bytes": 0,
+        "objects": 0, "crops": 0, "crop_pixels": 0, "mask_foregrounds": 0, "mask_foreground_pixels": 0,
+        "unlabelled": 0, "sizes": [],
+    }
+    for image_path in images:
+        size = image_size(image_path)
+        if size is None:
+            continue
+        img_width, img_height = size
+        scan["sizes"].append(size)
+        scan["image_bytes"] += os.path.getsize(image_path)
+        scan["image_pixels"] += img_width * img_height
+
+        filename = os.path.basename(image_path)
+        label_path = os.path.join(labels_dir, os.path.splitext(filename)[0] + ".txt")
+        mask_path = os.path.join(os.path.dirname(image_path), find_mask_for_image(filename))
+        if os.path.exists(label_path):
+            scan["label_bytes"] += os.path.getsize(label_path)
+            with open(label_path, 'r') as f:
+                for line in f:
+                    parts = line.strip().split()
+                    if len(parts) != 5:
+                        continue
+                    scan["objects"] += 1
+                    xmin, ymin, xmax, ymax = yolo_crop_box(*map(float, parts[1:]), img_width, img_height)
+                    w, h = xmax - xmin, ymax - ymin
+                    if w >= min_size[0] and h >= min_size[1]:
+                        scan["crops"] += 1
+                        scan["crop_pixels"] += w * h
+        elif os.path.exists(mask_path):
+            # Same component filter as crop_using_mask, which skips masks without a class
+            if not config["cropping"]["mask_class"]:
+                continue
+            mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
+            if mask is None:
+                continue
+            _, _, stats, _ = cv2.connectedComponentsWithStats((mask > 0).astype(np.uint8), connectivity=8)
+            widths, heights = stats[1:, 2], stats[1:, 3]
+            kept = (widths >= min_size[0]) & (heights >= min_size[1])
+            kept &= stats[1:, cv2.CC_STAT_AREA] >= config["bg_removal"]["min_foreground_pixels"]
+            scan["mask_foregrounds"] += int(kept.sum())
+            scan["mask_foreground_pixels"] += int((widths * heights)[kept].sum())
+        else:
+            scan["unlabelled"] += 1
+    return scan
+
+def scan_backgrounds(source_dirs: List[str], web_dir: str, web_limit: int, web_size: Tuple[int, int], pooled: bool) -> List[dict]:
+    """
+    Background count and pixels per source after dedup (per source, or over
+    all sources together when pooled). The web source is assumed to be filled
+    up to web_limit images of web_size by the download step.
+    """
+    paths = {}
+    for source_dir in source_dirs:
+        paths[source_dir] = [os.path.join(source_dir, f) for f in get_image_files(source_dir)] if os.path.isdir(source_dir) else []
+    if pooled:
+        kept = set(filter_near_duplicates([p for ps in paths.values() for p in ps], stage="backgrounds"))
+        paths = {d: [p for p in ps if p in kept] for d, ps in paths.items()}
+    else:
+        paths = {d: filter_near_duplicates(ps, stage="backgrounds") for d, ps in paths.items()}
+
+    sources = []
+    for source_dir, source_paths in paths.items():
+        sizes = [s for s in map(image_size, source_paths) if s is not None]
+        entry = {"dir": source_dir, "backgrounds": len(sizes), "pixels": sum(w * h for w, h in sizes), "to_download": 0}
+        if source_dir == web_dir and len(sizes) < web_limit:
+            entry["to_download"] = web_limit - len(sizes)
+            entry["backgrounds"] = web_limit
+            entry["pixels"] += entry["to_download"] * web_size[0] * web_size[1]
+        sources.append(entry)
+    return sources
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def _bytes(paths) -> int:
+    return sum(os.path.getsize(p) for p in paths if p and os.path.exists(p))
+
+def measure_throughput(
+    images_dir: str,
+    labels_dir: str,
+    background_paths: List[str],
+    class_names: List[str],
+    sample_size: int = config["plan"]["sample_size"],
+    session=None,
+    fallback_size: Tuple[int, int] = (512, 512)
+) -> dict:
+    """
+    Run each stage on a few inputs in a scratch directory and return seconds
+    per item plus output bytes per pixel (or per composite) for the size
+    estimates. Stages that cannot run (e.g. no model available) are left out.
+    Without backgrounds on disk, composites are sampled on a flat grey one of
+    fallback_size.
+    """
+    rates = {}
+    images = list_source_images(images_dir)[:sample_size] if os.path.isdir(images_dir) else []
+    if not images:
+        return rates
+
+    with tempfile.TemporaryDirectory(prefix="plan_") as scratch:
+        dirs = {name: os.path.join(scratch, name) for name in ("crops", "fg", "composites", "labels", "masks", "instances")}
+        for d in dirs.values():
+            os.makedirs(d)
+
+        crops, foregrounds = [], []
+        start = time.perf_counter()
+        for image_path in images:
+            c, f = crop_image(image_path, labels_dir, dirs["crops"], class_names, dirs["fg"])
+            crops += c
+            foregrounds += f
+        rates["crop_s_per_image"] = (time.perf_counter() - start) / len(images)
+        crop_pixels = sum(w * h for w, h in filter(None, map(image_size, crops)))
+        if crop_pixels:
+            rates["crop_bytes_per_pixel"] = _bytes(crops) / crop_pixels
+
+        if crops:
+            try:
+                adaptive = config["bg_removal"]["adaptive"]
+                max_side = adaptive["max_inference_side"] if adaptive["enabled"] else None
+                if session is None:
+                    session, rates["model_load_s"] = _timed(create_session)
+                sample = crops[:2 * sample_size]
+                start = time.perf_counter()
+                outputs = [remove_bg_file(Path(c), Path(dirs["fg"]), session, max_side, adaptive["refine_edges"]) for c in sample]
+                rates["bg_removal_s_per_crop"] = (time.perf_counter() - start) / len(sample)
+                kept = [str(o) for o in outputs if o is not None]
+                rates["bg_removal_pass_rate"] = len(kept) / len(sample)
+                foregrounds += kept
+            except Exception as e:
+                log.warning(f"Background removal could not be sampled: {e}")
+
+        fg_pixels = sum(w * h for w, h in filter(None, map(image_size, foregrounds)))
+        if fg_pixels:
+            rates["foreground_bytes_per_pixel"] = _bytes(foregrounds) / fg_pixels
+
+        arrays = [(os.path.basename(p), load_foreground(p)) for p in foregrounds]
+        arrays = [(name, fg) for name, fg in arrays if fg is not None]
+        if arrays:
+            names = [name for name, _ in arrays]
+            atlas = ForegroundAtlas.from_arrays(names, [find_class_id(n, class_names) for n in names], [fg for _, fg in arrays])
+            lesions = config["overlay"]["no_of_lesions"]
+            batches = [list(range(i, min(i + lesions, len(atlas)))) for i in range(0, len(atlas), lesions)]
+            # Real runs decode each background once per worker, so decoding is not timed
+            backgrounds = [np.asarray(Image.open(p).convert("RGB")) for p in background_paths[:sample_size]]
+            if not backgrounds:
+                backgrounds = [np.full((fallback_size[1], fallback_size[0], 3), 128, dtype=np.uint8)]
+            augment = config["overlay"]["augment"]
+            transforms = TransformCache(atlas, augment["cache_size"]) if augment["enabled"] else None
+            blending = config["overlay"]["blending"]
+            blend = get_blend_function(blending["mode"])
+            rng = random.Random(0)
+            written, pixels, seconds = [], 0, 0.0
+            for n, batch in enumerate(batches[:sample_size]):
+                background = backgrounds[n % len(backgrounds)]
+                start = time.perf_counter()
+                instance_map = np.zeros(background.shape[:2], dtype=np.uint8)
+                composite, lines = compose(
+                    background, atlas, batch, 20, rng, transforms=transforms, augment=augment,
+                    blend=blend, blend_params=blending, instance_map=instance_map
+                )
+                if not lines:
+                    continue
+                name = f"composite_{n + 1}"
+                paths = [os.path.join(dirs[d], f"{name}{ext}") for d, ext in
+                         (("composites", ".jpg"), ("labels", ".txt"), ("instances", ".png"), ("masks", ".png"))]
+                save_composite(composite, lines, paths[0], paths[1], instance_map, paths[2])
+                h, w = composite.shape[:2]
+                cv2.imwrite(paths[3], build_mask(paths[1], w, h))
+                seconds += time.perf_counter() - start
+                written.append(paths)
+                pixels += w * h
+            atlas.close()
+
+            if written:
+                rates["composite_s_per_image"] = seconds / len(written)
+                rates["label_bytes_per_composite"] = _bytes(p[1] for p in written) / len(written)
+                for key, idx in (("composite", 0), ("instance", 2), ("mask", 3)):
+                    rates[f"{key}_bytes_per_pixel"] = _bytes(p[idx] for p in written) / pixels
+                coco = empty_coco(class_names)
+                _, coco_seconds = _timed(
+                    add_coco_images, coco, dirs["composites"], dirs["labels"],
+                    [os.path.basename(p[0]) for p in written], "yolo", class_names, dirs["instances"]
+                )
+                rates["coco_s_per_image"] = coco_seconds / len(written)
+                if coco["annotations"]:
+                    rates["coco_bytes_per_annotation"] = len(json.dumps(coco["annotations"], indent=4)) / len(coco["annotations"])
+    return rates
+
+def _fmt_bytes(n: float) -> str:
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if abs(n) < 1024 or unit == "TB":
+            return f"{n:.1f} {unit}"
+        n /= 1024
+
+def _fmt_seconds(s: Optional[float]) -> str:
+    if s is None:
+        return "?"
+    return f"{s / 3600:.1f} h" if s >= 3600 else f"{s / 60:.1f} min" if s >= 60 else f"{s:.1f} s"
+
+def plan_run(
+    images_dir: str,
+    labels_dir: str,
+    backgrounds_dirs: List[str],
+    web_dir: str,
+    class_names: List[str],
+    output_json: Optional[str] = None,
+    measure: bool = True
+) -> dict:
+    """
+    Dry run: count the work each stage of main() would do with the current
+    config.yaml, estimate its wall time from throughput sampled on a few
+    images and its disk footprint from sampled bytes per pixel. Apart from
+    output_json and the dedup hash cache, nothing is written outside a
+    scratch directory.
+
+    Composite counts use the bg_removal pass rate measured on the sample; the
+    upper bound assumes every crop yields a foreground. When a sequential run
+    dedups crops before background removal, the call count is an upper bound
+    too, since crops do not exist yet to be hashed.
+    """
+    overlay = config["overlay"]
+    lesions = overlay["no_of_lesions"]
+    pipelined = config["pipeline"]["mode"] == "pipelined"
+    quotas = overlay["quotas"]["enabled"] and not pipelined
+    crop_dedup = config["dedup"]["enabled"] and not pipelined
+    quota_lesions = sum(resolve_class_targets(overlay["quotas"]["class_targets"], class_names).values()) if quotas else 0
+    if quotas and not quota_lesions:
+        log.warning("overlay.quotas is enabled without class_targets, so no composites will be generated.")
+
+    scan = scan_sources(images_dir, labels_dir)
+    sizes = scan.pop("sizes")
+    avg_size = tuple(int(np.mean(v)) for v in zip(*sizes)) if sizes else (512, 512)
+    sources = scan_backgrounds(backgrounds_dirs, web_dir, config["search"]["num_backgrounds"], avg_size, pooled=pipelined or quotas)
+    background_paths = [os.path.join(s["dir"], f) for s in sources if os.path.isdir(s["dir"]) for f in get_image_files(s["dir"])]
+
+    rates = measure_throughput(images_dir, labels_dir, background_paths, class_names, fallback_size=avg_size) if measure else {}
+    pass_rate = rates.get("bg_removal_pass_rate", 1.0)
+
+    def composite_counts(foregrounds: int) -> Tuple[int, int]:
+        """(composites, lesions placed) for a given number of foregrounds."""
+        if foregrounds == 0:
+            return 0, 0
+        if quotas:
+            # QuotaScheduler stops once the class targets are met
+            issued = min(overlay["quotas"]["budget"], math.ceil(quota_lesions / lesions))
+            return issued, min(quota_lesions, issued * lesions)
+        batches = math.ceil(foregrounds / lesions)
+        if pipelined:
+            # Each composite worker flushes its own partial batch at the end
+            batches += config["pipeline"]["workers"]["composite"] - 1
+        per_source = [s["backgrounds"] * batches for s in sources]
+        return sum(per_source), sum(s["backgrounds"] for s in sources) * foregrounds
+
+    fg_max = scan["mask_foregrounds"] + scan["crops"]
+    fg_expected = scan["mask_foregrounds"] + round(scan["crops"] * pass_rate)
+    composites, lesions_placed = composite_counts(fg_expected)
+    composites_max, _ = composite_counts(fg_max)
+    bg_pixels = sum(s["pixels"] for s in sources)
+    bg_count = sum(s["backgrounds"] for s in sources)
+    composite_pixels = composites * (bg_pixels / bg_count if bg_count else 0)
+
+    counts = {
+        "source_images": scan["images"],
+        "unlabelled_images": scan["unlabelled"],
+        "crops": scan["crops"],
+        "mask_foregrounds": scan["mask_foregrounds"],
+        "bg_removal_calls": scan["crops"],
+        "bg_removal_calls_exact": not crop_dedup,
+        "foregrounds_expected": fg_expected,
+        "foregrounds_max": fg_max,
+        "backgrounds": {s["dir"]: s["backgrounds"] for s in sources},
+        "backgrounds_to_download": sum(s["to_download"] for s in sources),
+        "composites_expected": composites,
+        "composites_max": composites_max,
+        "annotations_expected": lesions_placed,
+        "original_copies": scan["images"],
+    }
+
+    def estimate(rate_key, n):
+        return rates[rate_key] * n if rate_key in rates else None
+
+    overlay_workers = max(1, overlay["workers"])
+    stage_seconds = {
+        "crop": estimate("crop_s_per_image", scan["images"]),
+        "bg_removal": estimate("bg_removal_s_per_crop", scan["crops"]),
+        "overlay": estimate("composite_s_per_image", composites),
+        "coco": estimate("coco_s_per_image", composites + scan["images"]),
+    }
+    if pipelined:
+        workers = config["pipeline"]["workers"]
+        parallel = {"crop": workers["crop"], "bg_removal": workers["bg_removal"], "overlay": workers["composite"]}
+        stage_seconds = {k: (v / parallel.get(k, 1) if v is not None else None) for k, v in stage_seconds.items()}
+        # Stages overlap, so the slowest one bounds the run
+        overlapped = [v for k, v in stage_seconds.items() if k != "coco" and v is not None]
+        total = (max(overlapped) if overlapped else 0.0) + (stage_seconds["coco"] or 0.0)
+    else:
+        if stage_seconds["overlay"] is not None:
+            stage_seconds["overlay"] /= overlay_workers
+        total = sum(v for v in stage_seconds.values() if v is not None)
+    total += rates.get("model_load_s", 0.0)
+
+    def size(rate_key, pixels):
+        return rates[rate_key] * pixels if rate_key in rates else None
+
+    disk = {
+        "crops": size("crop_bytes_per_pixel", scan["crop_pixels"]),
+        "foregrounds": size("foreground_bytes_per_pixel", scan["crop_pixels"] * pass_rate + scan["mask_foreground_pixels"]),
+        "composites": size("composite_bytes_per_pixel", composite_pixels),
+        "labels": rates["label_bytes_per_composite"] * composites if "label_bytes_per_composite" in rates else None,
+        "instance_maps": size("instance_bytes_per_pixel", composite_pixels),
+        "masks": size("mask_bytes_per_pixel", composite_pixels + scan["image_pixels"]),
+        "originals": scan["image_bytes"] + scan["label_bytes"],
+        "coco_json": rates["coco_bytes_per_annotation"] * (lesions_placed + scan["objects"]) if "coco_bytes_per_annotation" in rates else None,
+        # Downloads are resized JPEGs like the composites, so they compress alike
+        "downloaded_backgrounds": size(
+            "composite_bytes_per_pixel", sum(s["to_download"] for s in sources) * avg_size[0] * avg_size[1]
+        ),
+    }
+    total_bytes = sum(v for v in disk.values() if v is not None)
+
+    plan = {
+        "mode": "pipelined" if pipelined else "quotas" if quotas else "sequential",
+        "counts": counts,
+        "throughput": rates,
+        "stage_seconds": stage_seconds,
+        "wall_seconds": total,
+        "disk_bytes": disk,
+        "total_bytes": total_bytes,
+    }
+
+    log.info(f"Run plan ({plan['mode']} mode)")
+    log.info(f"  source images   {scan['images']} ({scan['unlabelled']} without label or mask)")
+    calls = f"<= {scan['crops']} bg removal calls (crops are deduplicated first)" if crop_dedup else f"{scan['crops']} bg removal calls"
+    log.info(f"  crops           {scan['crops']} -> {calls}, {scan['mask_foregrounds']} mask foregrounds")
+    log.info(f"  foregrounds     ~{fg_expected} (max {fg_max}, bg removal pass rate {pass_rate:.0%})")
+    for s in sources:
+        extra = f" ({s['to_download']} to download)" if s["to_download"] else ""
+        log.info(f"  backgrounds     {s['backgrounds']} in {s['dir']}{extra}")
+    log.info(f"  composites      ~{composites} (max {composites_max}), ~{lesions_placed} annotations")
+    log.info(f"  originals       {scan['images']} copied")
+    for stage, seconds in stage_seconds.items():
+        log.info(f"  time {stage:<11} {_fmt_seconds(seconds)}")
+    if "model_load_s" in rates:
+        log.info(f"  time model load  {_fmt_seconds(rates['model_load_s'])}")
+    log.info(f"  estimated wall time {_fmt_seconds(total)}")
+    for name, n in disk.items():
+        log.info(f"  disk {name:<22} {_fmt_bytes(n) if n is not None else '?'}")
+    log.info(f"  estimated disk footprint {_fmt_bytes(total_bytes)}")
+
+    if output_json:
+        os.makedirs(os.path.dirname(output_json) or ".", exist_ok=True)
+        with open(output_json, 'w') as f:
+            json.dump(plan, f, indent=4)
+        log.info(f"Plan saved to {output_json}")
+    return plan
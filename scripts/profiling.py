@@ -0,0 +1,315 @@
+import os
+import sys
+import time
+import glob
+import html
+import pstats
+import shutil
+import cProfile
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from multiprocessing import util
+
+log = logging.getLogger(__name__)
+
+PROFILE_DIR_ENV = "MEDAUG_PROFILE_DIR"
+PROFILE_MODE_ENV = "MEDAUG_PROFILE_MODE"
+PROFILE_MODES = ("cprofile", "sampling")
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+    """
+    Samples the stacks of every thread in the process at a fixed interval and
+    counts them as collapsed stacks ("root;caller;callee" -> samples).
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(_frame_label(frame))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(labels))] += 1
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+def read_collapsed(path: str) -> Counter:
+    stacks = Counter()
+    with open(path, 'r') as f:
+        for line in f:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            if stack:
+                stacks[stack] += int(count)
+    return stacks
+
+def write_collapsed(stacks: Counter, path: str) -> None:
+    with open(path, 'w') as f:
+        for stack, count in sorted(stacks.items()):
+            f.write(f"{stack} {count}\n")
+
+def pstats_label(func: tuple) -> str:
+    filename, line, name = func
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+def pstats_to_collapsed(stats: pstats.Stats, max_depth: int = 64, min_us: int = 100) -> Counter:
+    """
+    Collapsed stacks (in microseconds of own time) rebuilt from a cProfile
+    caller graph. cProfile only records caller -> callee edges, so a
+    function's time below each call path is split in proportion to the
+    time of that edge; recursive calls are folded into their first frame and
+    paths below min_us are dropped.
+    """
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+    stacks = Counter()
+
+    def visit(func, path, on_path, seconds):
+        _, _, own, cumulative, _ = stats.stats[func]
+        share = seconds / cumulative if cumulative else 0.0
+        own_us = int(own * share * 1e6)
+        if own_us >= min_us:
+            stacks[";".join(path)] += own_us
+        if len(path) >= max_depth:
+            return
+        for callee, edge_seconds in callees.get(func, ()):
+            if callee in on_path or callee not in stats.stats:
+                continue
+            child_seconds = edge_seconds * share
+            if child_seconds * 1e6 >= min_us:
+                on_path.add(callee)
+                visit(callee, path + [pstats_label(callee)], on_path, child_seconds)
+                on_path.discard(callee)
+
+    for func, (_, _, _, cumulative, callers) in stats.stats.items():
+        if not any(caller in stats.stats for caller in callers):
+            visit(func, [pstats_label(func)], {func}, cumulative)
+    return stacks
+
+def write_flamegraph_svg(
+    stacks: Counter, path: str, title: str, width: int = 1200, row_height: int = 16, unit: str = "samples"
+) -> None:
+    """
+    Render collapsed stacks as a static SVG flamegraph (root at the bottom).
+    """
+    tree = {"children": {}, "count": 0}
+    for stack, count in stacks.items():
+        node = tree
+        node["count"] += count
+        for label in stack.split(";"):
+            node = node["children"].setdefault(label, {"children": {}, "count": 0})
+            node["count"] += count
+
+    def depth_of(node):
+        return 1 + max((depth_of(c) for c in node["children"].values()), default=0)
+
+    total = max(tree["count"], 1)
+    height = (depth_of(tree) + 1) * row_height
+    rects = []
+
+    def draw(node, label, x, depth):
+        w = width * node["count"] / total
+        if w < 0.5:
+            return
+        y = height - (depth + 1) * row_height
+        hue = 20 + (hash(label) % 40)
+        text = html.escape(label[:int(w / 7)]) if w > 21 else ""
+        rects.append(
+            f'<g><title>{html.escape(label)} ({node["count"]} {unit}, {100 * node["count"] / total:.1f}%)</title>'
+            f'<rect x="{x:.1f}" y="{y}" width="{w:.1f}" height="{row_height - 1}" fill="hsl({hue},90%,60%)"/>'
+            f'<text x="{x + 3:.1f}" y="{y + row_height - 4}" font-size="11" font-family="monospace">{text}</text></g>'
+        )
+        child_x = x
+        for child_label, child in sorted(node["children"].items()):
+            draw(child, child_label, child_x, depth + 1)
+            child_x += width * child["count"] / total
+
+    draw(tree, title, 0.0, 0)
+    with open(path, 'w') as f:
+        f.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}">\n')
+        f.write("\n".join(rects))
+        f.write("\n</svg>\n")
+
+def top_functions(stacks: Counter, top_n: int) -> list:
+    """
+    (function, self samples, inclusive samples) for the top_n functions by self time.
+    """
+    self_counts, inclusive = Counter(), Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        self_counts[frames[-1]] += count
+        for label in set(frames):
+            inclusive[label] += count
+    return [(label, count, inclusive[label]) for label, count in self_counts.most_common(top_n)]
+
+def profile_worker(stage: str) -> None:
+    """
+    Start profiling the current worker process when the parent runs with
+    --profile, and dump the result on exit. A no-op otherwise.
+    """
+    profile_dir = os.environ.get(PROFILE_DIR_ENV)
+    if not profile_dir:
+        return
+    worker_dir = os.path.join(profile_dir, "workers")
+    os.makedirs(worker_dir, exist_ok=True)
+    path = os.path.join(worker_dir, f"{stage}.{os.getpid()}")
+
+    if os.environ.get(PROFILE_MODE_ENV) == "sampling":
+        sampler = SamplingProfiler()
+        sampler.start()
+
+        def dump():
+            sampler.stop()
+            write_collapsed(sampler.stacks, path + ".collapsed")
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+        def dump():
+            profiler.disable()
+            profiler.dump_stats(path + ".prof")
+
+    util.Finalize(None, dump, exitpriority=10)
+
+class StageProfiler:
+    """
+    Per-stage profiling for main(). stage(name) is a no-op context when
+    output_dir is None, so an unprofiled run pays nothing. Repeated stages and
+    worker-process profiles of the same stage name are merged in finish().
+    """
+
+    def __init__(self, output_dir: str = None, mode: str = "cprofile", top_n: int = 25, interval: float = 0.005):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profiler '{mode}'. Use one of: {', '.join(PROFILE_MODES)}")
+        self.output_dir = output_dir
+        self.mode = mode
+        self.top_n = top_n
+        self.interval = interval
+        self.wall = Counter()
+        self._stats = {}
+        self._stacks = {}
+        if self.enabled:
+            # Drop worker dumps from earlier runs so they are not merged into this one
+            shutil.rmtree(os.path.join(output_dir, "workers"), ignore_errors=True)
+            os.makedirs(output_dir, exist_ok=True)
+            os.environ[PROFILE_DIR_ENV] = os.path.abspath(output_dir)
+            os.environ[PROFILE_MODE_ENV] = mode
+
+    @property
+    def enabled(self) -> bool:
+        return self.output_dir is not None
+
+    def stage(self, name: str):
+        if not self.enabled:
+            return nullcontext()
+        return self._profile(name)
+
+    @contextmanager
+    def _profile(self, name: str):
+        start = time.perf_counter()
+        if self.mode == "sampling":
+            sampler = SamplingProfiler(self.interval)
+            sampler.start()
+            try:
+                yield
+            finally:
+                sampler.stop()
+                self._stacks.setdefault(name, Counter()).update(sampler.stacks)
+                self.wall[name] += time.perf_counter() - start
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                stats = pstats.Stats(profiler)
+                if name in self._stats:
+                    self._stats[name].add(stats)
+                else:
+                    self._stats[name] = stats
+                self.wall[name] += time.perf_counter() - start
+
+    def _merge_workers(self) -> None:
+        worker_dir = os.path.join(self.output_dir, "workers")
+        for path in sorted(glob.glob(os.path.join(worker_dir, "*.prof"))):
+            name = os.path.basename(path).split(".")[0]
+            if name in self._stats:
+                self._stats[name].add(path)
+            else:
+                self._stats[name] = pstats.Stats(path)
+        for path in sorted(glob.glob(os.path.join(worker_dir, "*.collapsed"))):
+            name = os.path.basename(path).split(".")[0]
+            self._stacks.setdefault(name, Counter()).update(read_collapsed(path))
+
+    def finish(self) -> None:
+        """
+        Write per-stage profiles, collapsed stacks, flamegraphs and top-N
+        summaries plus an overall summary.txt to output_dir. In cprofile mode
+        the stacks are rebuilt from each .prof caller graph.
+        """
+        if not self.enabled:
+            return
+        self._merge_workers()
+        summary = [f"Profiler: {self.mode}", ""]
+        summary += [f"{name:<14} {seconds:9.2f}s wall" for name, seconds in self.wall.items()]
+
+        for name, stats in self._stats.items():
+            stats.dump_stats(os.path.join(self.output_dir, f"{name}.prof"))
+            with open(os.path.join(self.output_dir, f"{name}.top.txt"), 'w') as f:
+                stats.stream = f
+                stats.sort_stats("tottime").print_stats(self.top_n)
+                stats.sort_stats("cumulative").print_stats(self.top_n)
+            # Flamegraph input rebuilt from the caller graph, in microseconds
+            stacks = pstats_to_collapsed(stats)
+            write_collapsed(stacks, os.path.join(self.output_dir, f"{name}.collapsed"))
+            write_flamegraph_svg(stacks, os.path.join(self.output_dir, f"{name}.svg"), name, unit="us")
+            rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:5]
+            summary += ["", f"[{name}] top functions by own time:"]
+            summary += [f"  {tt:8.3f}s  {func[2]} ({os.path.basename(func[0])}:{func[1]})" for func, (_, _, tt, _, _) in rows]
+
+        for name, stacks in self._stacks.items():
+            write_collapsed(stacks, os.path.join(self.output_dir, f"{name}.collapsed"))
+            write_flamegraph_svg(stacks, os.path.join(self.output_dir, f"{name}.svg"), name)
+            top = top_functions(stacks, self.top_n)
+            total = max(sum(stacks.values()), 1)
+            with open(os.path.join(self.output_dir, f"{name}.top.txt"), 'w') as f:
+                f.write(f"{'self%':>7} {'incl%':>7}  function\n")
+                for label, own, incl in top:
+                    f.write(f"{100 * own / total:6.1f}% {100 * incl / total:6.1f}%  {label}\n")
+            summary += ["", f"[{name}] top functions by own samples:"]
+            summary += [f"  {100 * own / total:5.1f}%  {label}" for label, own, _ in top[:5]]
+
+        summary_path = os.path.join(self.output_dir, "summary.txt")
+        with open(summary_path, 'w') as f:
+            f.write("\n".join(summary) + "\n")
+        for line in summary:
+            log.info(line)
+        log.info(f"Profiles written to {self.output_dir}")
+        os.environ.pop(PROFILE_DIR_ENV, None)
+        os.environ.pop(PROFILE_MODE_ENV, None)
@@ -0,0 +1,117 @@
+import random
+import logging
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from scripts.foreground_atlas import ForegroundAtlas
+
+log = logging.getLogger(__name__)
+
+def resolve_class_targets(class_targets: dict, class_names: List[str]) -> Dict[int, int]:
+    """
+    Map config class targets (keyed by class name or class id) to class ids.
+    """
+    resolved = {}
+    for key, target in (class_targets or {}).items():
+        if isinstance(key, int):
+            class_id = key
+        elif key in class_names:
+            class_id = class_names.index(key)
+        else:
+            log.warning(f"Unknown class '{key}' in overlay.quotas.class_targets, ignoring.")
+            continue
+        resolved[class_id] = int(target)
+    return resolved
+
+class QuotaScheduler:
+    """
+    Issues composite jobs one at a time until every class has reached its
+    target number of placed lesions or the composite budget is spent.
+
+    Each job fills its lesion slots from the classes with the largest
+    remaining deficit, counting lesions in jobs that are still running as if
+    they will be placed. complete() reconciles the plan with what a worker
+    actually placed, so failed placements are re-issued and nothing beyond
+    the quotas is ever planned.
+    """
+
+    def __init__(
+        self,
+        atlas: ForegroundAtlas,
+        background_paths: List[str],
+        class_targets: Dict[int, int],
+        budget: int,
+        lesions_per_image: int,
+        rng: random.Random
+    ):
+        self.background_paths = list(background_paths)
+        self.budget = budget
+        self.lesions_per_image = lesions_per_image
+        self.rng = rng
+
+        self.foregrounds = {}
+        for class_id, target in class_targets.items():
+            members = [i for i in range(len(atlas)) if atlas.class_ids[i] == class_id]
+            if not members:
+                log.warning(f"No foregrounds for class {class_id}; its target of {target} cannot be met.")
+                continue
+            self.foregrounds[class_id] = members
+        self.targets = {c: class_targets[c] for c in self.foregrounds}
+
+        self.placed = Counter()
+        self.pending = Counter()
+        self.background_usage = [0] * len(self.background_paths)
+        self.issued = 0
+        self.written = 0
+
+    def deficit(self, class_id: int) -> int:
+        return self.targets[class_id] - self.placed[class_id] - self.pending[class_id]
+
+    def quotas_met(self) -> bool:
+        return all(self.placed[c] >= t for c, t in self.targets.items())
+
+    def next_job(self) -> Optional[Tuple[str, List[int], Counter]]:
+        """
+        Return (background path, atlas indices, planned class counts) for the
+        next composite, or None if nothing more should be issued right now.
+        """
+        if self.issued >= self.budget or not self.background_paths:
+            return None
+
+        planned = Counter()
+        fg_indices = []
+        for _ in range(self.lesions_per_image):
+            deficits = {c: self.deficit(c) - planned[c] for c in self.targets}
+            best = max(deficits.values(), default=0)
+            if best <= 0:
+                break
+            class_id = self.rng.choice([c for c, d in deficits.items() if d == best])
+            unused = [i for i in self.foregrounds[class_id] if i not in fg_indices]
+            fg_indices.append(self.rng.choice(unused or self.foregrounds[class_id]))
+            planned[class_id] += 1
+
+        if not fg_indices:
+            return None
+
+        least_used = min(self.background_usage)
+        bg_idx = self.rng.choice([i for i, n in enumerate(self.background_usage) if n == least_used])
+        self.background_usage[bg_idx] += 1
+        self.pending.update(planned)
+        self.issued += 1
+        return self.background_paths[bg_idx], fg_indices, planned
+
+    def complete(self, planned: Counter, placed_class_ids: List[int]) -> None:
+        self.pending.subtract(planned)
+        self.placed.update(placed_class_ids)
+        if placed_class_ids:
+            self.written += 1
+
+    def report(self) -> dict:
+        per_class = {c: (self.placed[c], t) for c, t in self.targets.items()}
+        for class_id, (placed, target) in per_class.items():
+            log.info(f"Class {class_id}: {placed}/{target} lesions placed")
+        log.info(
+            f"Quota scheduler: {self.written} composites written, {self.issued}/{self.budget} "
+            f"of budget issued, quotas {'met' if self.quotas_met() else 'NOT met'}"
+        )
+        return {"per_class": per_class, "written": self.written, "issued": self.issued, "quotas_met": self.quotas_met()}
@@ -0,0 +1,432 @@
+import os
+import re
+import json
+import time
+import errno
+import select
+import shutil
+import struct
+import ctypes
+import ctypes.util
+import logging
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+import numpy as np
+from PIL import Image
+import yaml
+
+from scripts.bg_removal import create_session
+from scripts.cropping_imgs import find_mask_for_image, is_source_image
+from scripts.overlay import instance_map_path
+from scripts.pipeline import Pipeline, build_stages, index_counter, load_backgrounds, warn_unsupported_options
+from scripts.yolo_to_json import add_coco_images, load_coco, remove_coco_images, save_coco
+from scripts.yolo_to_mask import build_mask
+
+def load_yaml(path = "config.yaml"):
+    with open(path,'r') as f:
+        return yaml.safe_load(f)
+
+config = load_yaml()
+
+log = logging.getLogger(__name__)
+
+WATCH_BACKENDS = ("auto", "inotify", "polling")
+
+class PollingWatcher:
+    """
+    Portable fallback: rescans the directories every wait() and reports files
+    whose size or mtime changed since the previous scan.
+    """
+
+    def __init__(self, dirs: List[str]):
+        self.dirs = dirs
+        self.stamps = self._scan()
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        stamps = {}
+        for directory in self.dirs:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            stat = entry.stat()
+                            stamps[entry.path] = (stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                continue
+        return stamps
+
+    def wait(self, timeout: float) -> Set[str]:
+        time.sleep(timeout)
+        stamps = self._scan()
+        changed = {path for path, stamp in stamps.items() if self.stamps.get(path) != stamp}
+        self.stamps = stamps
+        return changed
+
+    def close(self) -> None:
+        pass
+
+class InotifyWatcher:
+    """
+    Linux inotify through libc: reports files closed after writing or moved
+    into the directories, without rescanning them.
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, dirs: List[str]):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available on this platform")
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        for directory in dirs:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+            if wd < 0:
+                err = ctypes.get_errno()
+                self.close()
+                raise OSError(err, f"inotify_add_watch failed for {directory}")
+            self.watches[wd] = directory
+
+    def wait(self, timeout: float) -> Set[str]:
+        changed = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return changed
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, _, _, name_len = self._EVENT.unpack_from(data, offset)
+                offset += self._EVENT.size
+                name = data[offset:offset + name_len].rstrip(b"\0")
+                offset += name_len
+                if name and wd in self.watches:
+                    changed.add(os.path.join(self.watches[wd], os.fsdecode(name)))
+        return changed
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+def create_watcher(dirs: List[str], backend: str = config["watch"]["backend"]):
+    """
+    An inotify watcher when backend allows it and the platform supports it,
+    otherwise a PollingWatcher.
+    """
+    if backend not in WATCH_BACKENDS:
+        raise ValueError(f"Unknown watch backend '{backend}'. Use one of: {', '.join(WATCH_BACKENDS)}")
+    if backend != "polling":
+        try:
+            watcher = InotifyWatcher(dirs)
+            log.info("Watching with inotify")
+            return watcher
+        except OSError as e:
+            if backend == "inotify":
+                raise
+            log.info(f"inotify unavailable ({e}), falling back to polling")
+    return PollingWatcher(dirs)
+
+def _stamp(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+def next_composite_index(composites_dir: str) -> int:
+    indices = [
+        int(match.group(1)) for match in map(re.compile(r"composite_(\d+)\.").match, os.listdir(composites_dir)) if match
+    ]
+    return max(indices, default=0) + 1
+
+class WatchDaemon:
+    """
+    Keeps the background removal sessions, background library and COCO
+    dataset in memory and processes images added to (or changed in) the input
+    directories in batches through crop -> bg_removal -> composite -> write,
+    then appends the new composites and originals to the COCO JSON.
+
+    Files dropped into an inbox directory (e.g. data_root/images) are moved to
+    the matching input directory first, like the setup step of a full run.
+
+    Which composites each input image contributed lesions to is kept, with
+    the image's input stamps, in a state file next to the COCO JSON. When an
+    image changes, those composites are deleted from disk and from the COCO
+    dataset before it is processed again.
+    """
+
+    def __init__(
+        self,
+        images_dir: str,
+        labels_dir: str,
+        cropped_dir: str,
+        foregrounds_dir: str,
+        backgrounds_dirs: List[str],
+        composites_dir: str,
+        annotations_dir: str,
+        masks_dir: str,
+        instances_dir: str,
+        coco_json: str,
+        class_names: List[str],
+        inboxes: Optional[Dict[str, str]] = None
+    ):
+        self.images_dir = os.path.abspath(images_dir)
+        self.labels_dir = os.path.abspath(labels_dir)
+        self.output_dirs = (composites_dir, annotations_dir, masks_dir, instances_dir)
+        self.cropped_dir = cropped_dir
+        self.foregrounds_dir = foregrounds_dir
+        self.coco_json = coco_json
+        self.class_names = class_names
+        self.inboxes = {os.path.abspath(src): dst for src, dst in (inboxes or {}).items()}
+        for d in (images_dir, labels_dir, cropped_dir, foregrounds_dir, *self.output_dirs, *self.inboxes):
+            os.makedirs(d, exist_ok=True)
+
+        warn_unsupported_options()
+        start = time.perf_counter()
+        self.sessions = [create_session(worker=i) for i in range(config["pipeline"]["workers"]["bg_removal"])]
+        self.backgrounds = load_backgrounds(backgrounds_dirs)
+        self.coco = load_coco(coco_json, class_names)
+        self.next_index = index_counter(next_composite_index(composites_dir))
+        self.state_path = os.path.splitext(coco_json)[0] + "_watch_state.json"
+        self.processed: Dict[str, dict] = self._load_state()
+        self.latencies: List[float] = []
+        log.info(
+            f"Watch daemon ready in {time.perf_counter() - start:.1f}s: {len(self.sessions)} sessions, "
+            f"{len(self.backgrounds)} backgrounds, {len(self.coco['images'])} images in COCO"
+        )
+
+    def _load_state(self) -> Dict[str, dict]:
+        if not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path, 'r') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            log.warning(f"Ignoring unreadable watch state {self.state_path}: {e}")
+            return {}
+
+    def _save_state(self) -> None:
+        tmp = self.state_path + ".tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.processed, f)
+        os.replace(tmp, self.state_path)
+
+    def _ingest(self, path: str) -> Optional[str]:
+        """
+        Move a file that arrived in an inbox into its input directory and
+        return its new path; other paths are returned unchanged.
+        """
+        inbox = os.path.dirname(os.path.abspath(path))
+        if inbox not in self.inboxes:
+            return path
+        if not os.path.isfile(path):
+            return None
+        destination = os.path.join(self.inboxes[inbox], os.path.basename(path))
+        shutil.move(path, destination)
+        return destination
+
+    def _source_image(self, path: str) -> Optional[str]:
+        """
+        The input image a changed image, superpixel mask or label belongs to.
+        """
+        directory, name = os.path.split(os.path.abspath(path))
+        stem, ext = os.path.splitext(name)
+        if directory == self.labels_dir and ext == ".txt":
+            pass
+        elif directory == self.images_dir and name.endswith("_superpixels.png"):
+            stem = name[:-len("_superpixels.png")]
+        elif directory != self.images_dir or not is_source_image(name):
+            return None
+        for candidate_ext in (".jpg", ".png", ".JPG", ".PNG"):
+            candidate = os.path.join(self.images_dir, stem + candidate_ext)
+            if os.path.exists(candidate):
+                return candidate
+        return None
+
+    def _inputs_stamp(self, image_path: str) -> list:
+        stem = os.path.splitext(os.path.basename(image_path))[0]
+        stamps = (
+            _stamp(image_path),
+            _stamp(os.path.join(self.labels_dir, f"{stem}.txt")),
+            _stamp(os.path.join(self.images_dir, find_mask_for_image(os.path.basename(image_path)))),
+        )
+        # Lists, so stamps compare equal after a round trip through the state file
+        return [list(stamp) if stamp else None for stamp in stamps]
+
+    def _remove_stale_composites(self, images: List[str]) -> int:
+        """
+        Delete the composites (image, label, mask and instance map) rendered
+        from an earlier version of the given images, and their COCO entries.
+        Composites mixing lesions of several images go as a whole. Returns the
+        number removed.
+        """
+        stale = set()
+        for image in images:
+            stale.update(self.processed.get(image, {}).get("composites", ()))
+        if not stale:
+            return 0
+
+        composites_dir, annotations_dir, masks_dir, instances_dir = self.output_dirs
+        for name in stale:
+            stem = os.path.splitext(name)[0]
+            for path in (
+                os.path.join(composites_dir, name),
+                os.path.join(annotations_dir, f"{stem}.txt"),
+                os.path.join(masks_dir, f"{stem}.png"),
+                instance_map_path(instances_dir, name),
+            ):
+                if path and os.path.exists(path):
+                    os.remove(path)
+        remove_coco_images(self.coco, stale)
+
+        changed = set(images)
+        shared = 0
+        for image, entry in self.processed.items():
+            kept = [name for name in entry["composites"] if name not in stale]
+            if image not in changed:
+                shared += len(entry["composites"]) - len(kept)
+            entry["composites"] = kept
+        log.info(
+            f"Removed {len(stale)} composites rendered from the previous version of the changed images"
+            + (f" ({shared} lesion slots of unchanged images went with them)" if shared else "")
+        )
+        return len(stale)
+
+    def _copy_originals(self, images: List[str]) -> List[str]:
+        """
+        Copy each image, its label and its box mask into the outputs as orig_*,
+        as a full run does. Returns the copied image names.
+        """
+        composites_dir, annotations_dir, masks_dir, _ = self.output_dirs
+        copied = []
+        for image_path in images:
+            name = os.path.basename(image_path)
+            stem = os.path.splitext(name)[0]
+            shutil.copy(image_path, os.path.join(composites_dir, f"orig_{name}"))
+            label_path = os.path.join(self.labels_dir, f"{stem}.txt")
+            if os.path.exists(label_path):
+                shutil.copy(label_path, os.path.join(annotations_dir, f"orig_{stem}.txt"))
+            with Image.open(image_path) as img:
+                w, h = img.size
+            Image.fromarray(build_mask(label_path, w, h)).save(os.path.join(masks_dir, f"orig_{stem}.png"))
+            copied.append(f"orig_{name}")
+        return copied
+
+    def process_batch(self, changed: Set[str]) -> Optional[dict]:
+        """
+        Process the input images affected by the changed paths. Images whose
+        image, label and mask are unchanged since they were last processed are
+        skipped. Returns the batch report, or None if nothing needed work.
+        """
+        start = time.perf_counter()
+        images = set()
+        for path in changed:
+            path = self._ingest(path)
+            source = self._source_image(path) if path else None
+            if source is not None:
+                images.add(source)
+        stamps = {image: self._inputs_stamp(image) for image in images}
+        images = sorted(image for image in images if self.processed.get(image, {}).get("stamp") != stamps[image])
+        if not images:
+            return None
+
+        removed = self._remove_stale_composites(images)
+        composites_dir, annotations_dir, masks_dir, instances_dir = self.output_dirs
+        written = {}
+        stages = build_stages(
+            self.labels_dir, self.cropped_dir, self.foregrounds_dir, self.backgrounds,
+            composites_dir, annotations_dir, masks_dir, self.class_names,
+            lambda worker: self.sessions[worker % len(self.sessions)], self.next_index,
+            instances_dir=instances_dir, written=written
+        )
+        pipeline_report = Pipeline(stages, config["pipeline"]["queue_size"]).run(images)
+
+        coco_start = time.perf_counter()
+        originals = self._copy_originals(images)
+        added = add_coco_images(
+            self.coco, composites_dir, annotations_dir, sorted(written) + originals,
+            "yolo", self.class_names, instances_dir
+        )
+        save_coco(self.coco, self.coco_json)
+        coco_seconds = time.perf_counter() - coco_start
+
+        for image in images:
+            self.processed[image] = {
+                "stamp": stamps[image],
+                "composites": sorted(name for name, sources in written.items() if image in sources),
+            }
+        self._save_state()
+        latency = time.perf_counter() - start
+        self.latencies.append(latency)
+        log.info(
+            f"Batch {len(self.latencies)}: {len(images)} images -> {len(written)} composites "
+            f"({removed} stale removed), "
+            f"{added} COCO images updated in {latency:.2f}s "
+            f"(pipeline {pipeline_report.get('elapsed_s', 0.0):.2f}s, COCO {coco_seconds:.2f}s, "
+            f"{latency / len(images) * 1000:.0f} ms/image)"
+        )
+        return {
+            "images": len(images),
+            "composites": len(written),
+            "stale_removed": removed,
+            "latency_s": latency,
+            "coco_s": coco_seconds,
+            "pipeline": pipeline_report,
+        }
+
+    def report(self) -> dict:
+        if not self.latencies:
+            log.info("Watch daemon processed no batches")
+            return {"batches": 0}
+        latencies = np.array(self.latencies)
+        summary = {
+            "batches": len(latencies),
+            "mean_latency_s": float(latencies.mean()),
+            "p95_latency_s": float(np.percentile(latencies, 95)),
+            "max_latency_s": float(latencies.max()),
+        }
+        log.info(
+            f"Watch daemon: {summary['batches']} batches, latency mean {summary['mean_latency_s']:.2f}s, "
+            f"p95 {summary['p95_latency_s']:.2f}s, max {summary['max_latency_s']:.2f}s"
+        )
+        return summary
+
+    def run(self, stop: Optional[threading.Event] = None) -> dict:
+        """
+        Watch until stop is set or the process is interrupted. A batch is
+        processed once no new changes arrived for watch.settle_seconds, or as
+        soon as watch.max_batch changed files are pending.
+        """
+        settings = config["watch"]
+        stop = stop or threading.Event()
+        # Files already waiting in an inbox are moved in before watching starts
+        # and processed as the first batch
+        pending = set()
+        for inbox in self.inboxes:
+            for name in sorted(os.listdir(inbox)):
+                ingested = self._ingest(os.path.join(inbox, name))
+                if ingested is not None:
+                    pending.add(ingested)
+        watcher = create_watcher([self.images_dir, self.labels_dir, *self.inboxes])
+        log.info(f"Watching {self.images_dir} and {self.labels_dir} for new images (Ctrl+C to stop)")
+        try:
+            while not stop.is_set():
+                changed = watcher.wait(settings["settle_seconds"])
+                pending |= changed
+                if pending and (not changed or len(pending) >= settings["max_batch"]):
+                    batch, pending = pending, set()
+                    try:
+                        self.process_batch(batch)
+                    except Exception as e:
+                        log.exception(f"Batch failed: {e}")
+        except KeyboardInterrupt:
+            log.info("Stopping watch daemon")
+        finally:
+            watcher.close()
+        return self.report()
@@ -2,11 +2,132 @@ import os
 import json
 import logging
 import xml.etree.ElementTree as ET
-from typing import List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional
+import cv2
+import numpy as np
 from PIL import Image
+import yaml
+
+def load_yaml(path = "config.yaml"):
+    with open(path,'r') as f:
+        return yaml.safe_load(f)
+
+config = load_yaml()
 
 log = logging.getLogger(__name__)
 
+SEGMENTATION_FORMATS = ("rle", "polygon", "none")
+
+def encode_rle_counts(counts: np.ndarray) -> str:
+    """
+    COCO compressed RLE string of run lengths, vectorized over all runs: each
+    count (delta-coded against the count two runs back, from the fourth on) is
+    written as 5-bit little-endian groups with a continuation bit, offset by 48.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    values = counts.copy()
+    values[3:] -= counts[1:-2]
+
+    groups, keep = [], []
+    more = np.ones(values.size, dtype=bool)
+    while more.any():
+        chunk = values & 0x1F
+        values = values >> 5
+        sign = (chunk & 0x10) != 0
+        following = np.where(sign, values != -1, values != 0)
+        groups.append(chunk | np.where(following, 0x20, 0))
+        keep.append(more)
+        more = more & following
+
+    chars = np.stack(groups, axis=1) + 48
+    return chars[np.stack(keep, axis=1)].astype(np.uint8).tobytes().decode("ascii")
+
+def decode_rle_counts(encoded: str) -> np.ndarray:
+    """
+    Run lengths of a COCO compressed RLE string (inverse of encode_rle_counts).
+    """
+    counts, value, shift = [], 0, 0
+    for char in encoded.encode("ascii"):
+        chunk = char - 48
+        value |= (chunk & 0x1F) << (5 * shift)
+        shift += 1
+        if not chunk & 0x20:
+            if chunk & 0x10:
+                value |= -1 << (5 * shift)
+            if len(counts) > 2:
+                value += counts[-2]
+            counts.append(value)
+            value, shift = 0, 0
+    return np.array(counts, dtype=np.int64)
+
+def instance_rles(instance_map: np.ndarray, num_instances: int) -> Dict[int, Tuple[np.ndarray, int]]:
+    """
+    Column-major (COCO order) run lengths and pixel areas of instances
+    1..num_instances in an instance id map, from a single pass over the
+    image: runs of equal ids are found once and grouped per instance.
+    """
+    flat = instance_map.ravel(order="F")
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    ends = np.append(starts[1:], flat.size)
+    ids = flat[starts]
+
+    rles = {}
+    for instance_id in range(1, num_instances + 1):
+        hit = ids == instance_id
+        if not hit.any():
+            continue
+        # Alternating background/foreground runs, starting with background
+        edges = np.empty(2 * int(hit.sum()) + 2, dtype=np.int64)
+        edges[0], edges[-1] = 0, flat.size
+        edges[1:-1:2], edges[2:-1:2] = starts[hit], ends[hit]
+        lengths = np.diff(edges)
+        rles[instance_id] = (lengths, int(lengths[1::2].sum()))
+    return rles
+
+def box_rle(bbox: List[float], width: int, height: int) -> Tuple[np.ndarray, int]:
+    """
+    Run lengths and area of a filled box, for instances without a mask. Uses
+    the same pixel rounding as scripts.yolo_to_mask.build_mask.
+    """
+    x0, y0 = max(0, int(bbox[0])), max(0, int(bbox[1]))
+    x1, y1 = min(width - 1, int(bbox[0] + bbox[2])), min(height - 1, int(bbox[1] + bbox[3]))
+    box_w, box_h = max(0, x1 - x0), max(0, y1 - y0)
+    if box_w == 0 or box_h == 0:
+        return np.array([width * height], dtype=np.int64), 0
+
+    lengths = np.empty(2 * box_w + 1, dtype=np.int64)
+    lengths[0] = x0 * height + y0
+    lengths[1::2] = box_h
+    lengths[2:-1:2] = height - box_h
+    lengths[-1] = width * height - (x0 + box_w - 1) * height - y1
+    return lengths, box_w * box_h
+
+def rle_to_polygons(lengths: np.ndarray, width: int, height: int) -> List[List[float]]:
+    """
+    Outer contours of a run-length encoded mask as COCO polygons.
+    """
+    values = np.zeros(lengths.size, dtype=np.uint8)
+    values[1::2] = 1
+    mask = np.repeat(values, lengths).reshape((height, width), order="F")
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return [c.ravel().astype(float).tolist() for c in contours if len(c) >= 3]
+
+def load_instance_map(instances_dir: Optional[str], filename: str, width: int, height: int) -> Optional[np.ndarray]:
+    """
+    The per-instance id map written next to a composite, or None when there is
+    none (e.g. copied originals) or it does not match the image size.
+    """
+    if not instances_dir:
+        return None
+    path = os.path.join(instances_dir, os.path.splitext(filename)[0] + ".png")
+    if not os.path.exists(path):
+        return None
+    instance_map = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if instance_map is None or instance_map.shape != (height, width):
+        log.warning(f"Ignoring unusable instance map {path}")
+        return None
+    return instance_map
+
 def yolo_to_coco_bbox(
     x_center: float, y_center: float, width: float, height: float,
     img_width: int, img_height: int
@@ -68,36 +189,69 @@ def parse_voc_label(
         log.error(f"Failed to parse VOC label file {label_path}: {e}")
     return annotations
 
-def convert_dataset_to_coco(
-    images_dir: str,
-    labels_dir: str,
-    output_json: str,
-    label_format: str,
-    class_names: List[str]
-) -> None:
-    if label_format not in ('yolo', 'voc'):
-        log.error(f"Unsupported label format: {label_format}. Use 'yolo' or 'voc'.")
-        return
-
-    if not os.path.isdir(images_dir):
-        log.error(f"Images directory does not exist: {images_dir}")
-        return
+def empty_coco(class_names: List[str]) -> dict:
+    return {
+        "images": [],
+        "annotations": [],
+        "categories": [{"id": i + 1, "name": name} for i, name in enumerate(class_names)]
+    }
 
-    if not os.path.isdir(labels_dir):
-        log.error(f"Labels directory does not exist: {labels_dir}")
-        return
+def load_coco(path: str, class_names: List[str]) -> dict:
+    """
+    An existing COCO JSON to extend with add_coco_images, or an empty one.
+    """
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as json_file:
+                return json.load(json_file)
+        except (OSError, json.JSONDecodeError) as e:
+            log.warning(f"Ignoring unreadable COCO JSON {path}: {e}")
+    return empty_coco(class_names)
 
-    os.makedirs(os.path.dirname(output_json), exist_ok=True)
+def save_coco(coco: dict, output_json: str) -> None:
+    os.makedirs(os.path.dirname(output_json) or ".", exist_ok=True)
+    tmp = output_json + ".tmp"
+    try:
+        with open(tmp, 'w') as json_file:
+            json.dump(coco, json_file, indent=4)
+        os.replace(tmp, output_json)
+        log.info(f"COCO JSON saved to {output_json}")
+    except Exception as e:
+        log.error(f"Failed to save COCO JSON to {output_json}: {e}")
 
-    images = []
-    annotations = []
-    annotation_id = 1
-    image_id = 1
+def remove_coco_images(coco: dict, filenames) -> int:
+    """
+    Remove the images with the given file names and their annotations from
+    coco in place. Returns the number of images removed.
+    """
+    removed = set(filenames)
+    old_ids = {img["id"] for img in coco["images"] if img["file_name"] in removed}
+    if old_ids:
+        coco["images"] = [img for img in coco["images"] if img["id"] not in old_ids]
+        coco["annotations"] = [ann for ann in coco["annotations"] if ann["image_id"] not in old_ids]
+    return len(old_ids)
 
-    for filename in sorted(os.listdir(images_dir)):
-        if not filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-            continue
+def add_coco_images(
+    coco: dict,
+    images_dir: str,
+    labels_dir: str,
+    filenames: List[str],
+    label_format: str,
+    class_names: List[str],
+    instances_dir: Optional[str] = None,
+    segmentation: str = config["coco"]["segmentation"]
+) -> int:
+    """
+    Add the given images of images_dir and their annotations to coco in
+    place, replacing any entries already there under the same file name.
+    Returns the number of images added.
+    """
+    remove_coco_images(coco, filenames)
+    image_id = max((img["id"] for img in coco["images"]), default=0) + 1
+    annotation_id = max((ann["id"] for ann in coco["annotations"]), default=0) + 1
+    added = 0
 
+    for filename in filenames:
         img_path = os.path.join(images_dir, filename)
         try:
             img = Image.open(img_path)
@@ -106,7 +260,7 @@ def convert_dataset_to_coco(
             log.error(f"Failed to open image {img_path}: {e}")
             continue
 
-        images.append({
+        coco["images"].append({
             "id": image_id,
             "file_name": filename,
             "width": width,
@@ -123,31 +277,69 @@ def convert_dataset_to_coco(
             else:
                 parsed = parse_voc_label(label_path, width, height, class_names)
 
-            for class_id, bbox, area in parsed:
-                annotations.append({
+            masks = {}
+            if segmentation != "none":
+                instance_map = load_instance_map(instances_dir, filename, width, height)
+                if instance_map is not None:
+                    masks = instance_rles(instance_map, len(parsed))
+
+            for instance_id, (class_id, bbox, area) in enumerate(parsed, start=1):
+                annotation = {
                     "id": annotation_id,
                     "image_id": image_id,
                     "category_id": class_id + 1,
                     "bbox": [round(coord, 2) for coord in bbox],
                     "area": round(area, 2),
                     "iscrowd": 0
-                })
+                }
+                if segmentation != "none":
+                    lengths, area = masks.get(instance_id) or box_rle(bbox, width, height)
+                    annotation["area"] = area
+                    if segmentation == "rle":
+                        annotation["segmentation"] = {"size": [height, width], "counts": encode_rle_counts(lengths)}
+                    else:
+                        annotation["segmentation"] = rle_to_polygons(lengths, width, height)
+                coco["annotations"].append(annotation)
                 annotation_id += 1
         else:
             log.warning(f"Label file not found for image {filename}: {label_path}")
 
         image_id += 1
+        added += 1
+    return added
 
-    categories = [{"id": i + 1, "name": name} for i, name in enumerate(class_names)]
-    coco_format = {
-        "images": images,
-        "annotations": annotations,
-        "categories": categories
-    }
+def convert_dataset_to_coco(
+    images_dir: str,
+    labels_dir: str,
+    output_json: str,
+    label_format: str,
+    class_names: List[str],
+    instances_dir: Optional[str] = None,
+    segmentation: str = config["coco"]["segmentation"]
+) -> None:
+    """
+    Write a COCO JSON for the images in images_dir. Unless segmentation is
+    "none", every annotation gets a segmentation ("rle" or "polygon") and an
+    area counted from its mask: the instance map in instances_dir when the
+    image has one (instance k is the k-th label line), else its filled box.
+    """
+    if segmentation not in SEGMENTATION_FORMATS:
+        log.error(f"Unsupported segmentation format: {segmentation}. Use one of: {', '.join(SEGMENTATION_FORMATS)}.")
+        return
 
-    try:
-        with open(output_json, 'w') as json_file:
-            json.dump(coco_format, json_file, indent=4)
-        log.info(f"COCO JSON saved to {output_json}")
-    except Exception as e:
-        log.error(f"Failed to save COCO JSON to {output_json}: {e}")
+    if label_format not in ('yolo', 'voc'):
+        log.error(f"Unsupported label format: {label_format}. Use 'yolo' or 'voc'.")
+        return
+
+    if not os.path.isdir(images_dir):
+        log.error(f"Images directory does not exist: {images_dir}")
+        return
+
+    if not os.path.isdir(labels_dir):
+        log.error(f"Labels directory does not exist: {labels_dir}")
+        return
+
+    filenames = [f for f in sorted(os.listdir(images_dir)) if f.lower().endswith(('.jpg', '.jpeg', '.png'))]
+    coco = empty_coco(class_names)
+    add_coco_images(coco, images_dir, labels_dir, filenames, label_format, class_names, instances_dir, segmentation)
+    save_coco(coco, output_json)
@@ -5,6 +5,54 @@ import logging
 
 log = logging.getLogger(__name__)
 
+def build_mask(
+    label_file: str | Path,
+    w: int,
+    h: int,
+    multi_class: bool = False
+) -> np.ndarray:
+    """
+    Rasterize the boxes of a YOLO label file into an (h, w) uint8 mask.
+    A missing label file gives an empty mask.
+    """
+    label_file = Path(label_file)
+    mask = np.zeros((h, w), dtype=np.uint8)
+    if not label_file.exists():
+        return mask
+
+    with label_file.open() as f:
+        for line in f:
+            parts = line.strip().split()
+            if len(parts) != 5:
+                log.warning(f"Invalid YOLO label format in {label_file}")
+                continue
+            try:
+                cls, x_center, y_center, width, height = map(float, parts)
+                cls_id = int(cls) + 1 if multi_class else 255
+
+                # Convert to pixel coordinates
+                x_center *= w
+                y_center *= h
+                width *= w
+                height *= h
+
+                x_min = int(x_center - width / 2)
+                y_min = int(y_center - height / 2)
+                x_max = int(x_center + width / 2)
+                y_max = int(y_center + height / 2)
+
+                x_min = max(0, x_min)
+                y_min = max(0, y_min)
+                x_max = min(w - 1, x_max)
+                y_max = min(h - 1, y_max)
+
+                mask[y_min:y_max, x_min:x_max] = cls_id
+
+            except ValueError:
+                log.warning(f"Skipping line due to conversion error in {label_file}")
+                continue
+    return mask
+
 def yolo_to_masks(
     images_dir: str | Path,
     labels_dir: str | Path,
@@ -50,46 +98,10 @@ def yolo_to_masks(
             continue
         h, w, _ = img.shape
 
-        mask = np.zeros((h, w), dtype=np.uint8)
-
         if not label_file.exists():
             log.warning(f"No label found for {image_file.name}")
-            cv2.imwrite(str(mask_file), mask)
-            continue
 
-        with label_file.open() as f:
-            for line in f:
-                parts = line.strip().split()
-                if len(parts) != 5:
-                    log.warning(f"Invalid YOLO label format in {label_file}")
-                    continue
-                try:
-                    cls, x_center, y_center, width, height = map(float, parts)
-                    cls_id = int(cls) + 1 if multi_class else 255
-
-                    # Convert to pixel coordinates
-                    x_center *= w
-                    y_center *= h
-                    width *= w
-                    height *= h
-
-                    x_min = int(x_center - width / 2)
-                    y_min = int(y_center - height / 2)
-                    x_max = int(x_center + width / 2)
-                    y_max = int(y_center + height / 2)
-
-                    x_min = max(0, x_min)
-                    y_min = max(0, y_min)
-                    x_max = min(w - 1, x_max)
-                    y_max = min(h - 1, y_max)
-
-                    mask[y_min:y_max, x_min:x_max] = cls_id
-
-                except ValueError:
-                    log.warning(f"Skipping line due to conversion error in {label_file}")
-                    continue
-
-        cv2.imwrite(str(mask_file), mask)
+        cv2.imwrite(str(mask_file), build_mask(label_file, w, h, multi_class))
 
     log.info(f"Masks generated in: {masks_dir}")
 
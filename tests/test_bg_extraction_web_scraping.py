@@ -0,0 +1,160 @@
+import os
+import sys
+import time
+import subprocess
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from conftest import ROOT
+from scripts.bg_extraction_web_scraping import LocalDirectorySource, UrlListSource, fetch_backgrounds
+
+DISTINCT = 6
+
+class _CountingHandler(SimpleHTTPRequestHandler):
+    """
+    Static file handler that records requests and the most requests served
+    at once, with a small delay so concurrent downloads overlap.
+    """
+
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+    requests = 0
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.active += 1
+            cls.requests += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        try:
+            time.sleep(0.1)
+            super().do_GET()
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+def _write_image(path: Path, seed: int) -> None:
+    pixels = np.random.default_rng(seed).integers(0, 255, (32, 32, 3), dtype=np.uint8)
+    Image.fromarray(pixels).save(path)
+
+@pytest.fixture
+def server(tmp_path):
+    """
+    An http.server over a directory of DISTINCT images, each also served
+    under a second name (same bytes), plus a file that is not an image.
+    """
+    root = tmp_path / "served"
+    root.mkdir()
+    for i in range(DISTINCT):
+        _write_image(root / f"bg_{i}.png", i)
+        (root / f"copy_{i}.png").write_bytes((root / f"bg_{i}.png").read_bytes())
+    (root / "not_an_image.png").write_text("hello")
+
+    handler = type("Handler", (_CountingHandler,), {"active": 0, "max_active": 0, "requests": 0, "lock": threading.Lock()})
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), partial(handler, directory=str(root)))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{httpd.server_address[1]}"
+    try:
+        yield base, handler
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+def _urls(base: str):
+    urls = [f"{base}/bg_{i}.png" for i in range(DISTINCT)]
+    urls += [f"{base}/copy_{i}.png" for i in range(DISTINCT)]
+    urls += [f"{base}/missing.png", f"{base}/not_an_image.png"]
+    return urls
+
+def _fetch(source, limit, output_dir, cache_dir):
+    return fetch_backgrounds(source, limit, str(output_dir), cache_dir=str(cache_dir), concurrency=4, timeout=5, retries=0, resize_workers=1)
+
+def test_downloads_concurrently_and_dedups_by_content(server, tmp_path):
+    base, handler = server
+    report = _fetch(UrlListSource(_urls(base)), 50, tmp_path / "out", tmp_path / "cache")
+
+    assert handler.max_active > 1
+    assert report["images"] == DISTINCT
+    assert report["downloaded"] == 2 * DISTINCT
+    assert report["failed"] == 2
+    assert len(os.listdir(tmp_path / "out")) == DISTINCT
+    objects = [p for p in (tmp_path / "cache" / "objects").rglob("*") if p.is_file()]
+    assert len(objects) == DISTINCT
+
+def test_resumes_from_cache(server, tmp_path):
+    base, handler = server
+    _fetch(UrlListSource(_urls(base)), 50, tmp_path / "first", tmp_path / "cache")
+    served = handler.requests
+
+    report = _fetch(UrlListSource(_urls(base)), 50, tmp_path / "second", tmp_path / "cache")
+
+    # Only the two URLs that failed are requested again
+    assert handler.requests == served + 2
+    assert report["downloaded"] == 0
+    assert report["cached"] == DISTINCT
+    assert len(os.listdir(tmp_path / "second")) == DISTINCT
+
+def test_existing_outputs_count_against_limit(server, tmp_path):
+    base, _ = server
+    first = _fetch(UrlListSource(_urls(base)[:3]), 3, tmp_path / "out", tmp_path / "cache")
+    assert first["images"] == 3
+
+    report = _fetch(UrlListSource(_urls(base)), 4, tmp_path / "out", tmp_path / "cache")
+    assert report["existing"] == 3
+    assert report["images"] == 4
+    assert len(os.listdir(tmp_path / "out")) == 4
+
+    report = _fetch(UrlListSource(_urls(base)), 4, tmp_path / "out", tmp_path / "cache")
+    assert report["images"] == 4
+    assert report["downloaded"] == report["cached"] == 0
+    assert len(os.listdir(tmp_path / "out")) == 4
+
+def test_local_files_only_read_when_the_source_allows(tmp_path):
+    library = tmp_path / "library"
+    library.mkdir()
+    for i in range(3):
+        _write_image(library / f"bg_{i}.png", i)
+
+    report = _fetch(LocalDirectorySource(str(library)), 10, tmp_path / "out", tmp_path / "cache")
+    assert report["images"] == 3
+
+    class PlainPaths(UrlListSource):
+        reads_files = False
+
+    paths = [str(library / "bg_0.png"), (library / "bg_1.png").as_uri()]
+    report = _fetch(PlainPaths(paths), 10, tmp_path / "other", tmp_path / "other_cache")
+    assert report["images"] == 0
+    assert report["failed"] == 2
+
+def test_resize_after_rembg_import_exits(tmp_path):
+    """
+    main.py has rembg (and numba) loaded before backgrounds are resized; the
+    resize pool must not leave the interpreter hanging at exit.
+    """
+    pytest.importorskip("rembg")
+    library = tmp_path / "library"
+    library.mkdir()
+    for i in range(3):
+        _write_image(library / f"bg_{i}.png", i)
+
+    script = (
+        "import scripts.bg_removal\n"
+        "from scripts.bg_extraction_web_scraping import LocalDirectorySource, fetch_backgrounds\n"
+        f"report = fetch_backgrounds(LocalDirectorySource({str(library)!r}), 3, {str(tmp_path / 'out')!r}, 64, 64, "
+        f"cache_dir={str(tmp_path / 'cache')!r}, resize_workers=2)\n"
+        "assert report['resized'] == 3, report\n"
+    )
+    result = subprocess.run([sys.executable, "-c", script], cwd=ROOT, timeout=120, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert len(os.listdir(tmp_path / "out")) == 3